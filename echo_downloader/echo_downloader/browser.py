@@ -0,0 +1,52 @@
+import logging
+import os
+import subprocess
+import time
+from argparse import ArgumentParser
+
+import platformdirs
+
+from .cdp import find_chrome
+from .scraper import LOW_FOOTPRINT_ARGUMENTS
+
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    """
+    Keep a headless Chrome running, for echo-downloader to attach to with ``scraper.debugger_address``.
+    Chrome is restarted if it exits, its profile (and so its cookies) is kept between restarts.
+    """
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)-8s - %(message)s')
+
+    parser = ArgumentParser(description='Keep a headless Chrome running for echo-downloader to attach to')
+    parser.add_argument('--port', type=int, default=9222, help='Remote debugging port')
+    parser.add_argument('--chrome', type=str, default=find_chrome(), help='Path of the Chrome executable')
+    parser.add_argument('--user-data-dir', type=str,
+                        default=os.path.join(platformdirs.user_cache_dir('echo-downloader', 'anviks'), 'browser'),
+                        help='Profile directory of the browser')
+    args = parser.parse_args()
+
+    if args.chrome is None:
+        parser.error('Chrome was not found, use --chrome to specify its path')
+
+    command = [args.chrome, '--headless=new', f'--remote-debugging-port={args.port}',
+               '--remote-debugging-address=127.0.0.1', f'--user-data-dir={args.user_data_dir}',
+               *LOW_FOOTPRINT_ARGUMENTS, 'about:blank']
+
+    while True:
+        logger.info(f'Starting Chrome, set scraper.debugger_address to "127.0.0.1:{args.port}" to use it')
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            return_code = process.wait()
+        except KeyboardInterrupt:
+            process.terminate()
+            process.wait()
+            return
+
+        logger.warning(f'Chrome exited with code {return_code}, restarting it')
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
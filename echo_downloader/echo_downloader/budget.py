@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+from collections.abc import Iterable
+
+from .scheduler import DownloadJob
+
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+
+
+class DiskBudget:
+    """
+    Limits the disk space that the lectures in progress take up, by admitting a lecture only once its estimated size
+    fits into the budget next to the lectures already admitted. A limit of 0 means no limit.
+    A lecture that is larger than the whole budget is still admitted once no other lecture is in progress.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.__reserved: dict[int, int] = {}
+        self.__waiting: set[int] = set()
+        self.__released = asyncio.Event()
+
+    async def reserve(self, key: int, amount: int, name: str = '') -> None:
+        """
+        Wait until ``amount`` bytes fit into the budget and reserve them for ``key``.
+        Reserving a key that is already reserved returns immediately.
+        """
+        if self.limit <= 0:
+            return
+
+        if not self.__fits(key, amount) and key not in self.__waiting:
+            self.__waiting.add(key)
+            logger.info(f'Waiting for disk space for {name or key} ({amount / MEGABYTE:.0f} MB, '
+                        f'{self.used / MEGABYTE:.0f} of {self.limit / MEGABYTE:.0f} MB in use)')
+        while not self.__fits(key, amount):
+            # Every release sets the current event and replaces it, waking up all reservations waiting on it
+            await self.__released.wait()
+
+        self.__waiting.discard(key)
+        if key not in self.__reserved:
+            self.__reserved[key] = amount
+            self.used += amount
+
+    def release(self, key: int) -> None:
+        if key not in self.__reserved:
+            return
+
+        self.used -= self.__reserved.pop(key)
+        self.__released.set()
+        self.__released = asyncio.Event()
+
+    def __fits(self, key: int, amount: int) -> bool:
+        return key in self.__reserved or not self.__reserved or self.used + amount <= self.limit
+
+
+def estimate_lecture_bytes(jobs: Iterable[DownloadJob], file_infos: Iterable[dict[str, str]]) -> int:
+    """
+    Estimate the disk space a lecture needs at most: its downloaded files, plus a merged file as large as the inputs
+    of every merge, since a stream copy writes about as much as it reads. The sizes of the downloads are the
+    ``Content-Length`` of the files, files that are already on disk count with their current size.
+    """
+    download_sizes = {os.path.abspath(job.destination_path): job.info.size for job in jobs}
+    input_paths = {os.path.abspath(info[key]) for info in file_infos for key in ('audio_path', 'video_path')}
+
+    def get_size(path: str) -> int:
+        if path in download_sizes:
+            return download_sizes[path]
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    downloaded_bytes = sum(get_size(path) for path in download_sizes.keys() | input_paths)
+    merged_bytes = sum(get_size(os.path.abspath(info[key])) for info in file_infos
+                       for key in ('audio_path', 'video_path'))
+    return downloaded_bytes + merged_bytes
@@ -0,0 +1,359 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import defaultdict, deque
+from collections.abc import Coroutine, Iterable
+from typing import Any, Self
+from urllib.error import URLError
+
+import aiohttp
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+logger = logging.getLogger(__name__)
+
+CHROME_EXECUTABLES = ('google-chrome', 'google-chrome-stable', 'chromium', 'chromium-browser', 'chrome')
+STARTUP_TIMEOUT = 30
+COMMAND_TIMEOUT = 30
+PAGE_LOAD_TIMEOUT = 60
+
+# Finds elements like Selenium's locator strategies do
+FIND_ELEMENTS_FUNCTION = '''
+(strategy, value) => {
+    const links = () => Array.from(document.getElementsByTagName('a'));
+    switch (strategy) {
+        case 'css selector': return Array.from(document.querySelectorAll(value));
+        case 'xpath': {
+            const result = document.evaluate(value, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+            return Array.from({length: result.snapshotLength}, (_, i) => result.snapshotItem(i));
+        }
+        case 'class name': return Array.from(document.getElementsByClassName(value));
+        case 'tag name': return Array.from(document.getElementsByTagName(value));
+        case 'id': return Array.from(document.querySelectorAll('#' + CSS.escape(value)));
+        case 'name': return Array.from(document.querySelectorAll(`[name="${CSS.escape(value)}"]`));
+        case 'link text': return links().filter(link => link.innerText.trim() === value);
+        case 'partial link text': return links().filter(link => link.innerText.includes(value));
+        default: throw new Error(`Unsupported locator strategy: ${strategy}`);
+    }
+}
+'''
+
+# Runs a WebDriver style script (a function body reading ``arguments``), with the elements among the arguments
+# passed as separate call arguments and put back in their place
+SCRIPT_WRAPPER = '''
+function (template, ...elements) {
+    const revive = value => {
+        if (Array.isArray(value)) return value.map(revive);
+        if (value === null || typeof value !== 'object') return value;
+        if ('__element__' in value) return elements[value.__element__];
+        return Object.fromEntries(Object.entries(value).map(([key, item]) => [key, revive(item)]));
+    };
+    return (function () { {script} }).apply(null, revive(template));
+}
+'''
+
+
+class CdpError(WebDriverException):
+    pass
+
+
+class CdpElement:
+    """
+    A DOM element of the page, referenced by its remote object id until the page is left.
+    """
+
+    def __init__(self, driver: 'CdpDriver', object_id: str):
+        self.driver = driver
+        self.object_id = object_id
+
+
+class CdpDriver:
+    """
+    Controls a tab of Chrome over the DevTools protocol, without chromedriver in between.
+    All commands and events go over a single websocket, that an event loop in a background thread reads, so events
+    are collected as they arrive instead of being polled from a log.
+    Offers the part of Selenium's ``WebDriver`` interface that the scraper uses (``get``, ``find_element(s)``,
+    ``execute_script``, ``execute_cdp_cmd``, ``quit``), so it works with ``WebDriverWait`` and the configured locators.
+    The events named in ``recorded_events`` are kept until ``get_events`` is called.
+    """
+
+    def __init__(self, websocket_url: str, *, process: subprocess.Popen | None = None,
+                 recorded_events: Iterable[str] = ()):
+        self.process = process
+        self.recorded_events = frozenset(recorded_events)
+
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name='cdp-driver', daemon=True)
+        self.__thread.start()
+        self.__ids = itertools.count(1)
+        self.__pending: dict[int, asyncio.Future[dict[str, Any]]] = {}
+        self.__waiters: defaultdict[str, list[asyncio.Future[dict[str, Any]]]] = defaultdict(list)
+        self.__events: deque[dict[str, Any]] = deque()
+        self.__session: aiohttp.ClientSession | None = None
+        self.__reader: asyncio.Task[None] | None = None
+        self.__websocket: aiohttp.ClientWebSocketResponse | None = None
+        self.__session_id: str | None = None
+        self.__target_id: str | None = None
+
+        try:
+            self.__run(self.__connect(websocket_url))
+        except BaseException:
+            self.__run(self.__disconnect())
+            self.__stop_loop()
+            raise
+
+    @classmethod
+    def launch(cls, arguments: Iterable[str], profile_dir: str, *, chrome: str | None = None,
+               recorded_events: Iterable[str] = ()) -> Self:
+        """
+        Start Chrome with the arguments and connect to it, the browser is closed by ``quit``.
+        """
+        chrome = chrome or find_chrome()
+        if chrome is None:
+            raise CdpError('Chrome was not found')
+
+        # With port 0, Chrome picks a free port and writes it into the profile directory
+        port_file = os.path.join(profile_dir, 'DevToolsActivePort')
+        command = [chrome, '--remote-debugging-port=0', f'--user-data-dir={profile_dir}', *arguments, 'about:blank']
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        try:
+            deadline = time.time() + STARTUP_TIMEOUT
+            while True:
+                if process.poll() is not None:
+                    raise CdpError(f'Chrome exited with code {process.returncode} while starting')
+                try:
+                    with open(port_file) as f:
+                        lines = f.read().splitlines()
+                    if len(lines) >= 2:
+                        break
+                except FileNotFoundError:
+                    pass
+                if time.time() > deadline:
+                    raise CdpError(f'Chrome did not open its debugging port within {STARTUP_TIMEOUT} seconds')
+                time.sleep(0.05)
+
+            return cls(f'ws://127.0.0.1:{lines[0]}{lines[1]}', process=process, recorded_events=recorded_events)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+
+    @classmethod
+    def attach(cls, debugger_address: str, *, recorded_events: Iterable[str] = ()) -> Self:
+        """
+        Open a new tab in an already running browser, the tab is closed by ``quit`` and the browser is left running.
+        """
+        version_url = f'http://{debugger_address}/json/version'
+        try:
+            with urllib.request.urlopen(version_url, timeout=COMMAND_TIMEOUT) as response:
+                websocket_url = json.load(response)['webSocketDebuggerUrl']
+        except (URLError, OSError, ValueError, KeyError) as e:
+            raise CdpError(f'No browser to attach to at {debugger_address}: {e!r}') from e
+
+        return cls(websocket_url, recorded_events=recorded_events)
+
+    def get(self, url: str) -> None:
+        self.__run(self.__navigate(url))
+
+    def find_elements(self, by: str, value: str) -> list[CdpElement]:
+        return self.__run(self.__find_elements(by, value))
+
+    def find_element(self, by: str, value: str) -> CdpElement:
+        elements = self.find_elements(by, value)
+        if not elements:
+            raise NoSuchElementException(f'No element found with {by} "{value}"')
+        return elements[0]
+
+    def execute_script(self, script: str, *args: Any) -> Any:
+        return self.__run(self.__execute_script(script, args))
+
+    def execute_cdp_cmd(self, cmd: str, cmd_args: dict[str, Any]) -> dict[str, Any]:
+        return self.__run(self.__send(cmd, cmd_args))
+
+    def get_events(self) -> list[dict[str, Any]]:
+        """
+        Return the recorded events (with their ``method`` and ``params``) that arrived since the last call.
+        """
+        events = []
+        while self.__events:
+            events.append(self.__events.popleft())
+        return events
+
+    def quit(self) -> None:
+        try:
+            if self.process is None:
+                self.__run(self.__send('Target.closeTarget', {'targetId': self.__target_id}, in_page=False))
+            else:
+                self.__run(self.__send('Browser.close', {}, in_page=False))
+        except WebDriverException as e:
+            logger.debug(f'Failed to close the browser: {e.msg}')
+        finally:
+            self.__run(self.__disconnect())
+            self.__stop_loop()
+
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def __run[T](self, coroutine: Coroutine[Any, Any, T]) -> T:
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            raise CdpError(f'Communication with the browser failed: {e!r}') from e
+
+    def __stop_loop(self) -> None:
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    async def __connect(self, websocket_url: str) -> None:
+        self.__session = aiohttp.ClientSession()
+        # Response bodies can be larger than aiohttp's default message size limit
+        self.__websocket = await self.__session.ws_connect(websocket_url, max_msg_size=0)
+        self.__reader = asyncio.create_task(self.__read_messages())
+
+        # A started browser has opened a tab already, an attached one gets a tab of its own
+        if self.process is not None:
+            targets = await self.__send('Target.getTargets', {}, in_page=False)
+            self.__target_id = next((target['targetId'] for target in targets['targetInfos']
+                                     if target['type'] == 'page'), None)
+        if self.__target_id is None:
+            target = await self.__send('Target.createTarget', {'url': 'about:blank'}, in_page=False)
+            self.__target_id = target['targetId']
+
+        attached = await self.__send('Target.attachToTarget', {'targetId': self.__target_id, 'flatten': True},
+                                     in_page=False)
+        self.__session_id = attached['sessionId']
+        await self.__send('Page.enable', {})
+        await self.__send('Network.enable', {})
+
+    async def __disconnect(self) -> None:
+        if self.__websocket is not None:
+            await self.__websocket.close()
+        if self.__session is not None:
+            await self.__session.close()
+
+    async def __read_messages(self) -> None:
+        async for message in self.__websocket:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            data = json.loads(message.data)
+
+            if 'id' in data:
+                future = self.__pending.pop(data['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in data:
+                    future.set_exception(CdpError(f'{data["error"].get("message")} ({data["error"].get("code")})'))
+                else:
+                    future.set_result(data.get('result', {}))
+            elif data.get('sessionId') == self.__session_id:
+                method = data['method']
+                if method in self.recorded_events:
+                    self.__events.append({'method': method, 'params': data['params']})
+                for waiter in self.__waiters.pop(method, []):
+                    if not waiter.done():
+                        waiter.set_result(data['params'])
+
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_exception(CdpError('The connection to the browser was closed'))
+        self.__pending.clear()
+
+    async def __send(self, method: str, params: dict[str, Any], *, in_page: bool = True) -> dict[str, Any]:
+        message_id = next(self.__ids)
+        future = self.__loop.create_future()
+        self.__pending[message_id] = future
+
+        message: dict[str, Any] = {'id': message_id, 'method': method, 'params': params}
+        if in_page:
+            message['sessionId'] = self.__session_id
+
+        try:
+            await self.__websocket.send_str(json.dumps(message))
+            return await asyncio.wait_for(future, COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise CdpError(f'{method} got no response within {COMMAND_TIMEOUT} seconds')
+        finally:
+            self.__pending.pop(message_id, None)
+
+    async def __navigate(self, url: str) -> None:
+        """
+        Open the URL and wait for the page to load, like Selenium's default page load strategy.
+        """
+        loaded = self.__loop.create_future()
+        self.__waiters['Page.loadEventFired'].append(loaded)
+
+        try:
+            result = await self.__send('Page.navigate', {'url': url})
+            if result.get('errorText'):
+                raise CdpError(f'Failed to open {url}: {result["errorText"]}')
+            # Navigating within the same document has no loader and doesn't load anything
+            if 'loaderId' in result:
+                await asyncio.wait_for(loaded, PAGE_LOAD_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise CdpError(f'{url} did not load within {PAGE_LOAD_TIMEOUT} seconds')
+        finally:
+            if loaded in self.__waiters['Page.loadEventFired']:
+                self.__waiters['Page.loadEventFired'].remove(loaded)
+
+    async def __find_elements(self, by: str, value: str) -> list[CdpElement]:
+        expression = f'({FIND_ELEMENTS_FUNCTION})({json.dumps(by)}, {json.dumps(value)})'
+        result = await self.__send('Runtime.evaluate', {'expression': expression})
+        array_id = self.__get_result(result)['objectId']
+
+        properties = await self.__send('Runtime.getProperties', {'objectId': array_id, 'ownProperties': True})
+        await self.__send('Runtime.releaseObject', {'objectId': array_id})
+
+        items = sorted((int(item['name']), item['value']['objectId']) for item in properties['result']
+                       if item['name'].isdigit())
+        return [CdpElement(self, object_id) for _, object_id in items]
+
+    async def __execute_script(self, script: str, args: tuple[Any, ...]) -> Any:
+        elements: list[CdpElement] = []
+
+        def serialize(value: Any) -> Any:
+            if isinstance(value, CdpElement):
+                elements.append(value)
+                return {'__element__': len(elements) - 1}
+            if isinstance(value, (list, tuple)):
+                return [serialize(item) for item in value]
+            if isinstance(value, dict):
+                return {key: serialize(item) for key, item in value.items()}
+            return value
+
+        template = serialize(list(args))
+        global_object = await self.__send('Runtime.evaluate', {'expression': 'globalThis'})
+        result = await self.__send('Runtime.callFunctionOn', {
+            'functionDeclaration': SCRIPT_WRAPPER.replace('{script}', script),
+            'objectId': self.__get_result(global_object)['objectId'],
+            'arguments': [{'value': template}, *({'objectId': element.object_id} for element in elements)],
+            'returnByValue': True,
+            'awaitPromise': True,
+        })
+        return self.__get_result(result).get('value')
+
+    @staticmethod
+    def __get_result(response: dict[str, Any]) -> dict[str, Any]:
+        if 'exceptionDetails' in response:
+            details = response['exceptionDetails']
+            raise CdpError(f'JavaScript error: {details.get("exception", {}).get("description") or details["text"]}')
+        return response['result']
+
+
+def find_chrome() -> str | None:
+    for executable in CHROME_EXECUTABLES:
+        path = shutil.which(executable)
+        if path is not None:
+            return path
+    return None
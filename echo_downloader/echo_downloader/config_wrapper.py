@@ -5,6 +5,10 @@ from selenium.webdriver.common.by import By
 type LocatorStrategies = Literal[
     'id', 'xpath', 'link text', 'partial link text', 'name', 'tag name', 'class name', 'css selector']
 type Locator = tuple[LocatorStrategies, str]
+type DownloadOrder = Literal['listed', 'newest', 'oldest', 'pairs']
+type ScraperBackend = Literal['selenium', 'cdp', 'http']
+type ChecksumAlgorithm = Literal['none', 'md5', 'sha1', 'sha256']
+type MergeEngine = Literal['ffmpeg', 'native']
 
 by_values = tuple(v for k, v in dict(By.__dict__).items() if not k.startswith('_'))
 
@@ -15,6 +19,9 @@ class EchoDownloaderConfig:
     locators: 'Locators'
     attributes: 'Attributes'
     formats: 'Formats'
+    scraper: 'Scraper'
+    downloader: 'Downloader'
+    merger: 'Merger'
     logging: 'Logging'
     conversion_table: dict[str, dict[int, str]]
     file_pairs: dict[str, list[tuple[str, str]]]
@@ -36,6 +43,54 @@ class EchoDownloaderConfig:
         date_format: str
         time_format: str
 
+    class Scraper:
+        backend: ScraperBackend
+        syllabus_url: str
+        base_url: str
+        http_concurrency: int
+        browser_pool_size: int
+        stop_after_range: bool
+        debugger_address: str
+        low_footprint_browser: bool
+        blocked_urls: list[str]
+        cache_enabled: bool
+        lecture_list_ttl: int
+        file_urls_ttl: int
+        url_expiry_margin: int
+
+    class Downloader:
+        segments: int
+        min_segment_size: int
+        max_concurrent_files: int
+        connection_limit: int
+        connection_limit_per_host: int
+        keepalive_timeout: int
+        dns_cache_ttl: int
+        order: DownloadOrder
+        probe_missing_files: bool
+        connect_timeout: int
+        read_timeout: int
+        bandwidth_limit: int
+        per_file_bandwidth_limit: int
+        adaptive_concurrency: bool
+        min_streams: int
+        max_streams: int
+        adjust_interval: int
+        max_attempts: int
+        retry_base_delay: float
+        retry_max_delay: float
+        retry_budget: int
+        write_buffer_size: int
+        writer_threads: int
+        checksum: ChecksumAlgorithm
+        disk_budget: int
+
+    class Merger:
+        engine: MergeEngine
+        max_concurrent_merges: int
+        per_device_queues: bool
+        metrics_file: str
+
     class Logging:
         level: Literal['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
         format: str
@@ -10,6 +10,7 @@ class FileInfo:
     file_name: str
     url: str = ''
     local_path: str = ''
+    size: int = 0  # Content-Length of the file, 0 if it isn't known
 
 
 @dataclass(init=True, slots=True)
@@ -18,6 +19,7 @@ class Echo360Lecture:
     start_time: datetime | None = None
     end_time: datetime | None = None
     course_name: str = ''
+    lecture_id: str = ''
     url: str = ''
     week_number: int = 0
     lecture_in_week: int = 0
@@ -1,51 +1,342 @@
 import asyncio
+import json
 import logging
 import os
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass
+from typing import Self
 
-import aiofiles
 import aiohttp
 
+from .config_wrapper import EchoDownloaderConfig
 from .domain import Echo360Lecture
+from .manifest import DownloadManifest
+from .planner import plan_lecture_files
+from .retry import DownloadFailure, Retrier
+from .scheduler import DownloadJob, create_download_jobs, run_download_jobs
+from .sink import InlineHasher, WriterPool, create_file
+from .throttle import Throttle, TokenBucket
 
 logger = logging.getLogger(__name__)
 
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.json'
+STATE_SAVE_INTERVAL = 8 * 1024 * 1024
 
-async def download_files_from_urls(output_dir: str, lectures: list[Echo360Lecture]) -> None:
+
+class StalePartialDownloadError(aiohttp.ClientError):
+    pass
+
+
+@dataclass(slots=True)
+class RemoteFile:
+    size: int
+    accepts_ranges: bool
+    etag: str = ''
+    last_modified: str = ''
+
+
+@dataclass(slots=True)
+class DownloadedFile:
+    remote: RemoteFile
+    checksum: str | None = None
+
+
+@dataclass(slots=True)
+class PartialDownload:
+    """
+    Progress of an unfinished download, stored next to its part file.
+    Every range is a ``[start, end, downloaded_bytes]`` list, ``end`` being inclusive.
+    """
+    size: int
+    etag: str
+    last_modified: str
+    ranges: list[list[int]]
+
+    @property
+    def validator(self) -> str:
+        return self.etag or self.last_modified
+
+    @property
+    def downloaded_bytes(self) -> int:
+        return sum(byte_range[2] for byte_range in self.ranges)
+
+    @classmethod
+    def load(cls, part_path: str) -> Self:
+        with open(part_path + STATE_SUFFIX) as f:
+            return cls(**json.load(f))
+
+    def save(self, part_path: str) -> None:
+        with open(part_path + STATE_SUFFIX + '.tmp', 'w') as f:
+            json.dump(asdict(self), f)
+        os.replace(part_path + STATE_SUFFIX + '.tmp', part_path + STATE_SUFFIX)
+
+
+async def download_files_from_urls(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
+                                   manifest: DownloadManifest | None = None) -> list[DownloadFailure]:
+    """
+    Download the files of the lectures, returning the downloads that failed for good.
+    """
     logger.info('Downloading files...')
-    async with aiohttp.ClientSession() as session:
-        # Initial request to get the cookies
-        await session.get('https://echo360.org.uk/section/3b6b058c-10d1-4732-a414-3b8901fbffec/public')
-
-        tasks = []
-        for lecture in lectures:
-            if not lecture.file_infos:
-                continue
-            
-            folder = os.path.join(output_dir, lecture.encoded_course_name, f'week_{lecture.week_number}', f'lecture_{lecture.lecture_in_week}')
-            os.makedirs(folder, exist_ok=True)
-            
-            for info in lecture.file_infos:
-                if info.url is None:
-                    continue
-                destination_path = os.path.join(folder, info.file_name)
-                info.local_path = os.path.abspath(destination_path)
-                task = asyncio.create_task(download_file(session, destination_path, info.url))
-                tasks.append(task)              
+    retrier = Retrier(config.downloader)
 
-        await asyncio.gather(*tasks, return_exceptions=True)
-    logger.info('All files downloaded')
+    async with (create_session(config.downloader) as session, Throttle(config.downloader) as throttle,
+                WriterPool(config.downloader) as writers):
+        await warm_up_session(session)
+        await plan_lecture_files(config, session, lectures, output_dir, manifest)
+
+        jobs = create_download_jobs(config, output_dir, lectures, config.downloader.order, manifest)
+        await download_jobs(session, throttle, retrier, writers, config.downloader, jobs, manifest)
+
+    retrier.log_summary()
+    logger.info('All files downloaded' if not retrier.failures else 'Finished downloading files')
+    return retrier.failures
+
+
+async def download_jobs(session: aiohttp.ClientSession, throttle: Throttle, retrier: Retrier, writers: WriterPool,
+                        options: EchoDownloaderConfig.Downloader, jobs: list[DownloadJob],
+                        manifest: DownloadManifest | None = None,
+                        on_job_done: Callable[[DownloadJob], None] | None = None,
+                        before_job: Callable[[DownloadJob], Awaitable[None]] | None = None) -> None:
+    """
+    Download the files of the jobs in their order, calling ``on_job_done`` after each job, whether it succeeded or not.
+    ``before_job`` is awaited before a job starts, e.g. to wait for disk space.
+    """
+    await run_download_jobs(
+        jobs, lambda job: download_job(session, throttle, retrier, writers, job, options, manifest, on_job_done,
+                                       before_job),
+        options.max_concurrent_files)
+
+
+async def download_job(session: aiohttp.ClientSession, throttle: Throttle, retrier: Retrier, writers: WriterPool,
+                       job: DownloadJob, options: EchoDownloaderConfig.Downloader, manifest: DownloadManifest | None,
+                       on_job_done: Callable[[DownloadJob], None] | None,
+                       before_job: Callable[[DownloadJob], Awaitable[None]] | None = None) -> None:
+    if before_job is not None:
+        await before_job(job)
+
+    try:
+        downloaded = await retrier.run(
+            lambda: download_file(session, throttle, writers, job.destination_path, job.info.url, options),
+            f'{job.info.file_name} of {job.lecture.title}')
+
+        if downloaded is not None and manifest is not None:
+            manifest.record_file(job.lecture.lecture_id, job.info.file_name, url=job.info.url,
+                                 size=downloaded.remote.size, etag=downloaded.remote.etag,
+                                 checksum=downloaded.checksum, local_path=job.destination_path)
+    finally:
+        if on_job_done is not None:
+            on_job_done(job)
+
+
+def create_session(options: EchoDownloaderConfig.Downloader) -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=options.connection_limit,
+        limit_per_host=options.connection_limit_per_host,
+        keepalive_timeout=options.keepalive_timeout,
+        ttl_dns_cache=options.dns_cache_ttl,
+    )
+    # No limit on the total time, a download only fails once the connection stalls
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=options.connect_timeout, sock_read=options.read_timeout)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def warm_up_session(session: aiohttp.ClientSession) -> None:
+    # Initial request to get the cookies
+    async with session.get('https://echo360.org.uk/section/3b6b058c-10d1-4732-a414-3b8901fbffec/public'):
+        pass
+
+
+async def download_file(session: aiohttp.ClientSession, throttle: Throttle, writers: WriterPool, destination_path: str,
+                        url: str, options: EchoDownloaderConfig.Downloader) -> DownloadedFile | None:
+    """
+    Download the file, returning what the server reported about it and the checksum of its content (if enabled),
+    or None if it had already been downloaded.
+    Interrupted downloads are resumed, so calling this again after a failure only fetches the missing bytes.
+    """
+    # Files are only moved to their final path once complete, so an existing file needs no request at all
+    if os.path.exists(destination_path):
+        return None
+
+    part_path = destination_path + PART_SUFFIX
+    file_bucket = throttle.file_bucket()
+    hasher = writers.create_hasher(part_path)
+
+    try:
+        remote = await probe_file(session, url)
+
+        if not remote.accepts_ranges:
+            remove_partial_download(part_path)
+            await download_stream(session, throttle, writers, file_bucket, part_path, url, remote, hasher)
+        else:
+            partial = load_partial_download(part_path, remote)
+            if partial is not None:
+                logger.info(f'Resuming {destination_path} at {partial.downloaded_bytes}/{partial.size} bytes')
+
+            try:
+                await download_ranges(session, throttle, writers, file_bucket, part_path, url,
+                                      partial or create_partial_download(part_path, remote, options), hasher)
+            except StalePartialDownloadError:
+                logger.warning(f'{url} changed since the download started, restarting it')
+                hasher = writers.create_hasher(part_path)
+                await download_ranges(session, throttle, writers, file_bucket, part_path, url,
+                                      create_partial_download(part_path, remote, options), hasher)
+
+        checksum = await writers.finish_hash(hasher) if hasher is not None else None
+        if checksum is not None and not matches_etag(checksum, remote, options):
+            remove_partial_download(part_path)
+            raise aiohttp.ClientPayloadError(f'MD5 of {url} ({checksum}) does not match its ETag {remote.etag}')
+
+        os.replace(part_path, destination_path)
+        remove_partial_download(part_path)
+        return DownloadedFile(remote, checksum)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        throttle.failed()
+        raise
+
+
+async def probe_file(session: aiohttp.ClientSession, url: str) -> RemoteFile:
+    """
+    Send a HEAD request for the file, returning its size, validators and whether the server accepts byte range requests.
+    """
+    async with session.head(url, allow_redirects=True, timeout=60) as response:
+        response.raise_for_status()
+        size = int(response.headers.get('Content-Length', 0))
+        accepts_ranges = response.headers.get('Accept-Ranges', 'none').lower() == 'bytes'
+        return RemoteFile(size=size,
+                          accepts_ranges=accepts_ranges and size > 0,
+                          etag=response.headers.get('ETag', ''),
+                          last_modified=response.headers.get('Last-Modified', ''))
+
+
+def matches_etag(checksum: str, remote: RemoteFile, options: EchoDownloaderConfig.Downloader) -> bool:
+    """
+    Compare the MD5 checksum of a download with the ETag of the file, if the ETag is a plain MD5 of the content.
+    The ETags of files uploaded in parts have a part count suffix and can't be compared.
+    """
+    etag = remote.etag.removeprefix('W/').strip('"').lower()
+    if options.checksum != 'md5' or len(etag) != 32 or any(c not in '0123456789abcdef' for c in etag):
+        return True
+    return checksum == etag
+
+
+async def download_stream(session: aiohttp.ClientSession, throttle: Throttle, writers: WriterPool,
+                          file_bucket: TokenBucket, destination_path: str, url: str, remote: RemoteFile,
+                          hasher: InlineHasher | None) -> None:
+    async with throttle.stream(), session.get(url) as response:
+        response.raise_for_status()
+        create_file(destination_path, remote.size)
+        sink = writers.open(destination_path, 0, hasher)
+        try:
+            async for chunk in response.content.iter_any():
+                await sink.write(chunk)
+                await throttle.transferred(file_bucket, len(chunk))
+            await sink.flush()
+        finally:
+            sink.close()
+
+        if remote.size and sink.written_bytes != remote.size:
+            raise aiohttp.ClientPayloadError(f'Connection closed after {sink.written_bytes} of {remote.size} bytes')
+
+
+def create_partial_download(part_path: str, remote: RemoteFile, options: EchoDownloaderConfig.Downloader) -> PartialDownload:
+    """
+    Start a new partial download, preallocating the part file and splitting it into byte ranges.
+    """
+    segment_count = max(min(options.segments, remote.size // max(options.min_segment_size, 1)), 1)
+    segment_size = -(-remote.size // segment_count)
+    ranges = [[start, min(start + segment_size, remote.size) - 1, 0] for start in range(0, remote.size, segment_size)]
+
+    create_file(part_path, remote.size)
+
+    partial = PartialDownload(remote.size, remote.etag, remote.last_modified, ranges)
+    partial.save(part_path)
+    return partial
 
 
-async def download_file(session: aiohttp.ClientSession, destination_path: str, url: str) -> None:
+def load_partial_download(part_path: str, remote: RemoteFile) -> PartialDownload | None:
+    """
+    Load the state of an interrupted download, if there is one and the remote file hasn't changed since.
+    """
     try:
-        async with session.get(url, timeout=30 * 60) as response:
-            # Return if the file already exists
-            if os.path.exists(destination_path) and os.path.getsize(destination_path) == int(response.headers.get('Content-Length', 0)):
-                return
-            response.raise_for_status()
-            async with aiofiles.open(destination_path, 'wb') as f:
-                async for chunk in response.content.iter_any():
-                    await f.write(chunk)
-    except aiohttp.ClientError as e:
-        logger.error(f"Failed to download {url}: {e}")
-        await asyncio.sleep(0)  # Yield to the event loop to prevent blocking
+        partial = PartialDownload.load(part_path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != partial.size:
+        return None
+    if (partial.size, partial.etag, partial.last_modified) != (remote.size, remote.etag, remote.last_modified):
+        return None
+    if not partial.validator:
+        # Without a validator there is no way to tell whether the remote file is still the same one
+        return None
+
+    return partial
+
+
+def remove_partial_download(part_path: str) -> None:
+    for path in (part_path, part_path + STATE_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def download_ranges(session: aiohttp.ClientSession, throttle: Throttle, writers: WriterPool,
+                          file_bucket: TokenBucket, part_path: str, url: str, partial: PartialDownload,
+                          hasher: InlineHasher | None) -> None:
+    """
+    Download the remaining parts of every range of the partial download in parallel,
+    each written at its offset in the preallocated part file.
+    """
+    pending = [byte_range for byte_range in partial.ranges if byte_range[0] + byte_range[2] <= byte_range[1]]
+    logger.debug(f'Downloading {url} in {len(pending)} segments')
+    if hasher is not None:
+        for start, _, downloaded_bytes in partial.ranges:
+            hasher.mark_written(start, downloaded_bytes)
+
+    tasks = [asyncio.create_task(download_range(session, throttle, writers, file_bucket, part_path, url, partial,
+                                                byte_range, hasher))
+             for byte_range in pending]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        partial.save(part_path)
+
+
+async def download_range(session: aiohttp.ClientSession, throttle: Throttle, writers: WriterPool,
+                         file_bucket: TokenBucket, part_path: str, url: str, partial: PartialDownload,
+                         byte_range: list[int], hasher: InlineHasher | None) -> None:
+    start, end, previously_downloaded = byte_range
+    headers = {'Range': f'bytes={start + byte_range[2]}-{end}'}
+    if partial.validator:
+        headers['If-Range'] = partial.validator
+
+    async with throttle.stream(), session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status != 206:
+            # The server ignores the range when the validator no longer matches and sends the whole file instead
+            raise StalePartialDownloadError(f'Expected a partial response for {headers["Range"]}, got {response.status}')
+
+        saved_bytes = 0
+        sink = writers.open(part_path, start + previously_downloaded, hasher)
+        try:
+            async for chunk in response.content.iter_any():
+                await sink.write(chunk)
+                await throttle.transferred(file_bucket, len(chunk))
+
+                # Only bytes that have reached the file count as downloaded in the saved state
+                byte_range[2] = previously_downloaded + sink.written_bytes
+                if sink.written_bytes - saved_bytes >= STATE_SAVE_INTERVAL:
+                    partial.save(part_path)
+                    saved_bytes = sink.written_bytes
+            await sink.flush()
+        finally:
+            byte_range[2] = previously_downloaded + sink.written_bytes
+            sink.close()
+
+        if start + byte_range[2] <= end:
+            raise aiohttp.ClientPayloadError(f'Connection closed after {byte_range[2]} bytes of {headers["Range"]}')
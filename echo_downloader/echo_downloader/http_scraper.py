@@ -0,0 +1,229 @@
+import asyncio
+import html
+import logging
+import os
+import re
+from datetime import datetime as dt
+from html.parser import HTMLParser
+from types import TracebackType
+from typing import Any, Self
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .config_wrapper import EchoDownloaderConfig
+from .domain import Echo360Lecture, FileInfo
+from .planner import get_sibling_url
+from .scrape_cache import ScrapeCache
+from .scraper import MANIFEST_EXTENSIONS, STREAM_NAME_PATTERN, EchoScraper
+
+logger = logging.getLogger(__name__)
+
+SECTION_ID_PATTERN = re.compile(r'/section/([^/?#]+)')
+URL_PATTERN = re.compile(r'https?://[^\s"\'<>\\]+')
+
+
+class ScrapingError(Exception):
+    pass
+
+
+class CourseNameParser(HTMLParser):
+    """
+    Collects the text of the first ``h1`` element, without the text of its child elements.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.depth = 0
+        self.texts: list[str] = []
+        self.done = False
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if self.done:
+            return
+        if self.depth or tag == 'h1':
+            self.depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if self.depth:
+            self.depth -= 1
+            self.done = self.depth == 0
+
+    def handle_data(self, data: str) -> None:
+        if self.depth == 1 and data.strip():
+            self.texts.append(data.strip())
+
+
+class EchoHttpScraper(EchoScraper):
+    """
+    Scrapes the course without a browser, reading the course page, its syllabus JSON and the lecture pages over HTTP.
+    The file URLs are taken from the lecture pages, or from the stream manifests that the pages refer to.
+    With ``scraper.base_url`` set, the Echo360 pages are requested from that server instead, e.g. one serving
+    recorded pages.
+    """
+
+    def __init__(self, configuration: EchoDownloaderConfig, course_title: str, lecture_indices: slice, *,
+                 cache: ScrapeCache | None = None, skipped_lecture_ids: set[str] | None = None,
+                 since: dt | None = None, until: dt | None = None):
+        super().__init__(configuration, course_title, lecture_indices, cache=cache,
+                         skipped_lecture_ids=skipped_lecture_ids, since=since, until=until)
+        self.__session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self.__session is None:
+            raise RuntimeError(f'{self.__class__.__name__} is only usable while scraping.')
+        return self.__session
+
+    def scrape_all_lectures(self) -> None:
+        asyncio.run(self.scrape_all_lectures_async())
+
+    async def scrape_all_lectures_async(self) -> None:
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with aiohttp.ClientSession(timeout=timeout, raise_for_status=True) as session:
+            self.__session = session
+            try:
+                await self.scrape_with_session()
+            finally:
+                self.__session = None
+
+    async def scrape_with_session(self) -> None:
+        logger.info('Collecting lecture URLs...')
+        if not self.restore_cached_lectures():
+            await self.get_all_lecture_urls_async()
+            if not self.lectures:
+                raise ScrapingError(f'No lectures found on {self.course_url}')
+            self.cache_lectures()
+        self.assign_numbers()
+
+        logger.info('Collecting lecture file URLs...')
+        semaphore = asyncio.Semaphore(max(self.config.scraper.http_concurrency, 1))
+
+        async def get_files(lecture: Echo360Lecture) -> None:
+            async with semaphore:
+                logger.info(f'Collecting file URLs for {lecture.title}')
+                lecture.file_infos = await self.get_lecture_files_async(lecture.url)
+
+        lectures = self.restore_cached_file_infos(self.get_wanted_lectures())
+        await asyncio.gather(*(get_files(lecture) for lecture in lectures))
+        self.cache_file_infos(lectures)
+
+    async def get_all_lecture_urls_async(self) -> None:
+        course_name = await self.get_course_name_async()
+
+        section_match = SECTION_ID_PATTERN.search(urlparse(self.course_url).path)
+        if section_match is None:
+            raise ScrapingError(f'No section id in {self.course_url}')
+        syllabus_url = self.config.scraper.syllabus_url.format(section_id=section_match.group(1))
+
+        row_limit = self.get_row_limit()
+        try:
+            async with self.session.get(self.rebase_url(syllabus_url)) as response:
+                # Error statuses are raised by the session. Without a valid session, Echo360 answers with a login page
+                # instead of JSON
+                syllabus = await response.json(content_type=None)
+
+            for item in syllabus['data']:
+                if len(self.lectures) == row_limit:
+                    break
+                lecture = self.parse_lesson(item['lesson'], course_name)
+                if lecture is not None:
+                    self.lectures.append(lecture)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ScrapingError(f'Unexpected syllabus format at {syllabus_url}: {e!r}') from e
+
+    def parse_lesson(self, item: dict[str, Any], course_name: str) -> Echo360Lecture | None:
+        """
+        Turn a syllabus entry into a lecture, with the same date and time values as the course page shows.
+        Lectures that haven't taken place yet, or have no scheduled time, are left out, like on the course page.
+        """
+        lesson = item['lesson']
+        timing = lesson.get('timing')
+        if item.get('isFuture') or not timing:
+            return None
+
+        start = dt.fromisoformat(timing['start'])
+        end = dt.fromisoformat(timing['end'])
+
+        lecture = Echo360Lecture()
+        lecture.course_name = course_name
+        lecture.date = dt(start.year, start.month, start.day)
+        lecture.start_time = dt(1900, 1, 1, start.hour, start.minute)
+        lecture.end_time = dt(1900, 1, 1, end.hour, end.minute)
+        lecture.lecture_id = lesson['id']
+        lecture.url = self.config.formats.lecture_url.format(lecture_id=lecture.lecture_id)
+        return lecture
+
+    async def get_course_name_async(self) -> str:
+        async with self.session.get(self.rebase_url(self.course_url)) as response:
+            parser = CourseNameParser()
+            parser.feed(await response.text())
+
+        if not parser.texts:
+            raise ScrapingError(f'No course name found on {self.course_url}')
+        return parser.texts[-1]
+
+    async def get_lecture_files_async(self, lecture_url: str) -> list[FileInfo]:
+        async with self.session.get(self.rebase_url(lecture_url)) as response:
+            page = await response.text()
+
+        lecture_file_infos: dict[str, FileInfo] = {}
+        manifest_urls: list[str] = []
+
+        for url in find_urls(page):
+            file_name = os.path.basename(urlparse(url).path)
+            if file_name in self.searched_files:
+                lecture_file_infos.setdefault(file_name, FileInfo(file_name, url))
+            elif file_name.endswith(MANIFEST_EXTENSIONS) and url not in manifest_urls:
+                manifest_urls.append(url)
+
+        for manifest_url in manifest_urls:
+            if len(lecture_file_infos) == len(self.searched_files):
+                break
+            await self.read_manifest(manifest_url, lecture_file_infos)
+
+        if not lecture_file_infos:
+            logger.warning(f'No files found for {lecture_url}')
+        return list(lecture_file_infos.values())
+
+    async def read_manifest(self, manifest_url: str, lecture_file_infos: dict[str, FileInfo]) -> None:
+        """
+        Add the searched files that the manifest lists, next to the manifest and signed like it.
+        """
+        try:
+            async with self.session.get(manifest_url) as response:
+                body = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f'Failed to read {manifest_url}: {e!r}')
+            return
+
+        for stream_name in dict.fromkeys(STREAM_NAME_PATTERN.findall(body)):
+            for file_name in self.searched_files:
+                if os.path.splitext(file_name)[0] == stream_name:
+                    url = get_sibling_url(manifest_url, file_name)
+                    lecture_file_infos.setdefault(file_name, FileInfo(file_name, url))
+
+    def rebase_url(self, url: str) -> str:
+        base_url = self.config.scraper.base_url
+        if not base_url:
+            return url
+
+        parsed_base = urlparse(base_url)
+        return urlparse(url)._replace(scheme=parsed_base.scheme, netloc=parsed_base.netloc).geturl()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self,
+                 exc_type: type[BaseException] | None,
+                 exc_val: BaseException | None,
+                 exc_tb: TracebackType | None) -> None:
+        pass
+
+
+def find_urls(page: str) -> list[str]:
+    """
+    Find the absolute URLs in a page, including the ones in its embedded JSON.
+    """
+    page = html.unescape(page.replace('\\/', '/').replace('\\u0026', '&'))
+    return URL_PATTERN.findall(page)
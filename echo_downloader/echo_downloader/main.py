@@ -1,17 +1,31 @@
 import asyncio
 import logging
 import os
-from argparse import ArgumentParser, ArgumentTypeError
+import sys
+import time
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from datetime import datetime
+from typing import get_args
 
+import aiohttp
 import yaml
 from plyer import notification
 from utils_anviks import dict_to_object
 import platformdirs
 
-from .config_wrapper import EchoDownloaderConfig
+from .config_wrapper import DownloadOrder, EchoDownloaderConfig, MergeEngine, ScraperBackend
+from .domain import Echo360Lecture
 from .downloader import download_files_from_urls
+from .http_scraper import EchoHttpScraper, ScrapingError
+from .manifest import DownloadManifest
+from .pipeline import download_and_merge
+from .retry import DownloadFailure
+from .scrape_cache import ScrapeCache
 from .scraper import EchoScraper
-from .merger import merge_files_concurrently
+from .stream_merger import stream_and_merge
+from .merger import get_file_infos, get_merge_failures, get_output_path, is_output_done, merge_files_concurrently
+
+logger = logging.getLogger(__name__)
 
 
 def slice_type(s) -> slice:
@@ -30,11 +44,118 @@ def slice_type(s) -> slice:
                                 "but the colon must be present.")
 
 
-def main() -> None:
-    config_dir = platformdirs.user_config_dir('echo-downloader', 'anviks', roaming=True)
-    default_config_path = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
-    custom_config_path = os.path.join(config_dir, 'config.yaml')
-    
+def date_type(s) -> datetime:
+    try:
+        return datetime.strptime(s, '%Y-%m-%d')
+    except ValueError:
+        raise ArgumentTypeError("Invalid date format. Must be YYYY-MM-DD.")
+
+
+def scrape_courses(config: EchoDownloaderConfig, args: Namespace, course_titles: list[str], cache: ScrapeCache | None,
+                   skipped_lecture_ids: dict[str, set[str]]) -> dict[str, list[Echo360Lecture]]:
+    """
+    Scrape the lectures of every course, one course after another with the same scraper (and so the same browsers).
+    Courses that the http scraper fails on are scraped with Selenium afterwards.
+    """
+    lecture_indices = args.slice or slice(None)
+    lectures: dict[str, list[Echo360Lecture]] = {}
+    remaining_titles = course_titles
+
+    if config.scraper.backend == 'http':
+        remaining_titles = []
+        with EchoHttpScraper(config, course_titles[0], lecture_indices, cache=cache, since=args.since,
+                             until=args.until) as scraper:
+            for course_title in course_titles:
+                scraper.select_course(course_title, skipped_lecture_ids[course_title])
+                try:
+                    scraper.scrape_all_lectures()
+                    lectures[course_title] = scraper.lectures
+                except (aiohttp.ClientError, asyncio.TimeoutError, ScrapingError) as e:
+                    logger.warning(f'Scraping {course_title} without a browser failed ({e!r}), '
+                                   f'falling back to Selenium')
+                    remaining_titles.append(course_title)
+
+    if remaining_titles:
+        with EchoScraper(config, remaining_titles[0], lecture_indices, headless=True, cache=cache, since=args.since,
+                         until=args.until) as scraper:
+            for course_title in remaining_titles:
+                scraper.select_course(course_title, skipped_lecture_ids[course_title])
+                scraper.scrape_all_lectures()
+                lectures[course_title] = scraper.lectures
+
+    return {course_title: lectures[course_title] for course_title in course_titles}
+
+
+def download_lectures(config: EchoDownloaderConfig, args: Namespace, lectures: list[Echo360Lecture],
+                      manifest: DownloadManifest) -> list[DownloadFailure]:
+    if args.no_intermediate:
+        return asyncio.run(stream_and_merge(config, args.output, lectures, manifest))
+    if args.pipeline or config.downloader.disk_budget > 0:
+        # Only the pipeline deletes the files of a lecture as soon as it is merged, which the disk budget relies on
+        return asyncio.run(download_and_merge(config, args.output, lectures, manifest))
+
+    failures = asyncio.run(download_files_from_urls(config, args.output, lectures, manifest))
+    merge_results = merge_files_concurrently(config, args.output, lectures, manifest=manifest)
+    return failures + get_merge_failures(merge_results)
+
+
+def process_courses(config: EchoDownloaderConfig, args: Namespace, course_titles: list[str],
+                    manifest: DownloadManifest,
+                    scrape_cache: ScrapeCache | None) -> tuple[list[Echo360Lecture], list[DownloadFailure]]:
+    """
+    Scrape, download and merge the lectures of the courses, returning the processed lectures and the failed downloads.
+    The lectures of all courses are downloaded and merged together, so the concurrency limits apply to the whole run.
+    In watch mode, only the lectures that no earlier watch run has finished are processed.
+    """
+    seen_lecture_ids = {
+        course_title: manifest.get_seen_lecture_ids(config.course_urls[course_title]) if args.watch else set()
+        for course_title in course_titles
+    }
+
+    lectures_by_course = scrape_courses(config, args, course_titles, scrape_cache, seen_lecture_ids)
+    # Lectures whose recording isn't available yet have no files, they are picked up by a later run
+    processed_by_course = {
+        course_title: [lecture for lecture in lectures if lecture.file_infos]
+        for course_title, lectures in lectures_by_course.items()
+    }
+    if args.watch:
+        for course_title, processed_lectures in processed_by_course.items():
+            logger.info(f'Found {len(processed_lectures)} new lecture(s) of {course_title}')
+
+    processed_lectures = [lecture for lectures in processed_by_course.values() for lecture in lectures]
+    if not processed_lectures:
+        return [], []
+
+    lectures = [lecture for lectures in lectures_by_course.values() for lecture in lectures]
+    failures = download_lectures(config, args, lectures, manifest)
+    if args.watch:
+        # Lectures with failed downloads or merges are tried again by the next run
+        for course_title, course_lectures in processed_by_course.items():
+            manifest.record_seen_lectures(config.course_urls[course_title],
+                                          [lecture.lecture_id for lecture in course_lectures
+                                           if is_lecture_finished(config, args.output, lecture, manifest)])
+    return processed_lectures, failures
+
+
+def is_lecture_finished(config: EchoDownloaderConfig, output_dir: str, lecture: Echo360Lecture,
+                        manifest: DownloadManifest) -> bool:
+    """
+    A lecture is finished once at least one of its outputs and every output planned for it have been merged, by this
+    run or an earlier one. The planner leaves out the outputs that were merged already, so the ones it found no files
+    for, e.g. after a partial capture, only count as finished if another output exists.
+    """
+    output_paths = [get_output_path(output_dir, lecture, title_suffix) for title_suffix in config.file_pairs]
+    planned_paths = [info['output_path'] for info in get_file_infos(config, output_dir, [lecture])]
+    return (any(is_output_done(lecture, path, manifest) for path in output_paths)
+            and all(is_output_done(lecture, path, manifest) for path in planned_paths))
+
+
+def load_config(default_config_path: str, custom_config_path: str) -> EchoDownloaderConfig:
+    """
+    Load the default config, with every section that the user's config has replaced by the user's one.
+    The user's config is created as a copy of the default one on the first run, so it lacks the sections that later
+    versions add, and new keys have to go into new sections.
+    """
     with open(default_config_path) as f:
         file_contents = f.read()
         
@@ -48,7 +169,17 @@ def main() -> None:
         with open(custom_config_path) as f:
             config_dict.update(yaml.safe_load(f))
             
-    config = dict_to_object(config_dict, EchoDownloaderConfig)
+    return dict_to_object(config_dict, EchoDownloaderConfig)
+
+
+def main() -> None:
+    config_dir = platformdirs.user_config_dir('echo-downloader', 'anviks', roaming=True)
+    default_config_path = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
+    custom_config_path = os.path.join(config_dir, 'config.yaml')
+    manifest_path = os.path.join(platformdirs.user_data_dir('echo-downloader', 'anviks'), 'manifest.sqlite3')
+    scrape_cache_dir = os.path.join(platformdirs.user_cache_dir('echo-downloader', 'anviks'), 'scrape')
+    
+    config = load_config(default_config_path, custom_config_path)
     
     logging.basicConfig(
         level=config.logging.level,
@@ -58,29 +189,131 @@ def main() -> None:
 
     parser = ArgumentParser(description='Echo360 video downloader')
     parser.add_argument('-s', '--slice', type=slice_type,
-                        help='Slice object in the format start:stop[:step], will be used to slice the list of lectures',
-                        required=True)
-    parser.add_argument('-c', '--course', type=str, choices=config.course_abbreviations.keys(),
-                        help='Course for which to download lectures', required=True)
+                        help='Slice object in the format start:stop[:step], will be used to slice the list of lectures '
+                             '(required unless --watch is used)')
+    parser.add_argument('--since', type=date_type,
+                        help='Only download lectures held on this date (YYYY-MM-DD) or later')
+    parser.add_argument('--until', type=date_type,
+                        help='Only download lectures held on this date (YYYY-MM-DD) or earlier')
+    parser.add_argument('--stop-after-range', action='store_true',
+                        help='Only read the lecture rows up to the end of the slice (overrides the config)')
+    parser.add_argument('-c', '--course', type=str, nargs='+', choices=[*config.course_abbreviations.keys(), 'all'],
+                        help='Courses for which to download lectures, "all" for every course', required=True)
     parser.add_argument('-o', '--output', type=str, default='.', help='Output directory')
     parser.add_argument('-n', '--notify', action='store_true', help='Send a notification after the script finishes')
+    parser.add_argument('--scraper', type=str, choices=get_args(ScraperBackend.__value__),
+                        help='How lecture pages are read, with a browser (through Selenium or the DevTools protocol) '
+                             'or directly over HTTP (overrides the config)')
+    parser.add_argument('--attach', type=str, metavar='ADDRESS',
+                        help='Attach to a running browser at host:port instead of starting one, '
+                             'e.g. one kept alive by echo-downloader-browser (overrides the config)')
+    parser.add_argument('--browsers', type=int,
+                        help='Number of browsers collecting lecture file URLs at the same time (overrides the config)')
+    parser.add_argument('--order', type=str, choices=get_args(DownloadOrder.__value__),
+                        help='Order in which files are downloaded (overrides the config)')
+    parser.add_argument('--max-downloads', type=int,
+                        help='Number of files downloaded at the same time (overrides the config)')
+    parser.add_argument('--connections-per-host', type=int,
+                        help='Number of simultaneous connections to a single host (overrides the config)')
+    parser.add_argument('--bandwidth-limit', type=int,
+                        help='Bytes per second for all downloads together, 0 for no limit (overrides the config)')
+    parser.add_argument('--disk-budget', type=int,
+                        help='Bytes of disk space the lectures in progress may take up, 0 for no limit, '
+                             'implies --pipeline (overrides the config)')
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument('-p', '--pipeline', action='store_true',
+                            help='Merge the files of every lecture as soon as they are downloaded, '
+                                 'instead of waiting for all downloads to finish')
+    mode_group.add_argument('--no-intermediate', action='store_true',
+                            help="Pipe the downloads straight into ffmpeg without writing the audio and video files "
+                                 "to disk (POSIX only)")
+    parser.add_argument('--merge-engine', type=str, choices=get_args(MergeEngine.__value__),
+                        help='Merge with ffmpeg or with the built-in MP4 remuxer (overrides the config)')
+    parser.add_argument('--metrics-file', type=str,
+                        help='Append the timing and throughput of every merge to this file as JSON lines '
+                             '(overrides the config)')
+    parser.add_argument('--refresh', action='store_true',
+                        help="Don't use cached lecture lists and file URLs, scrape everything again")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Only process lectures that earlier watch runs have not processed yet')
+    parser.add_argument('--watch-interval', type=int,
+                        help='Keep running and check for new lectures every this many seconds (implies --watch)')
+    parser.add_argument('--ignore-manifest', action='store_true',
+                        help="Don't skip files and merges that earlier runs have recorded as finished")
     args = parser.parse_args()
 
-    full_course_title = config.course_abbreviations[args.course]
+    if args.watch_interval:
+        args.watch = True
+    if args.slice is None and not args.watch:
+        parser.error('the following arguments are required: -s/--slice (unless --watch is used)')
+    if args.no_intermediate and os.name != 'posix':
+        parser.error('--no-intermediate is only supported on POSIX systems')
+    if args.no_intermediate and args.disk_budget:
+        parser.error('--disk-budget has no effect with --no-intermediate, which writes no audio and video files')
+
+    if args.stop_after_range:
+        config.scraper.stop_after_range = True
+    if args.scraper is not None:
+        config.scraper.backend = args.scraper
+    if args.attach is not None:
+        config.scraper.debugger_address = args.attach
+    if args.browsers is not None:
+        config.scraper.browser_pool_size = args.browsers
+    if args.order is not None:
+        config.downloader.order = args.order
+    if args.max_downloads is not None:
+        config.downloader.max_concurrent_files = args.max_downloads
+    if args.connections_per_host is not None:
+        config.downloader.connection_limit_per_host = args.connections_per_host
+    if args.bandwidth_limit is not None:
+        config.downloader.bandwidth_limit = args.bandwidth_limit
+    if args.disk_budget is not None:
+        config.downloader.disk_budget = args.disk_budget
+    if args.merge_engine is not None:
+        config.merger.engine = args.merge_engine
+    if args.no_intermediate and config.downloader.disk_budget > 0:
+        logger.warning('The disk budget is ignored with --no-intermediate, which writes no audio and video files')
+    if args.metrics_file is not None:
+        config.merger.metrics_file = args.metrics_file
+
+    if 'all' in args.course:
+        course_titles = list(dict.fromkeys(config.course_abbreviations.values()))
+    else:
+        course_titles = list(dict.fromkeys(config.course_abbreviations[course] for course in args.course))
+
+    scrape_cache = None
+    if config.scraper.cache_enabled:
+        # Watch mode exists to notice new lectures, so it always reads the lecture list again
+        scrape_cache = ScrapeCache(scrape_cache_dir, config.scraper, read=not args.refresh,
+                                   read_lecture_lists=not args.watch)
+
+    with DownloadManifest(manifest_path, skip_finished=not args.ignore_manifest) as manifest:
+        while True:
+            try:
+                processed_lectures, failures = process_courses(config, args, course_titles, manifest, scrape_cache)
+            except Exception as e:
+                if not args.watch_interval:
+                    raise
+                # A long running watcher keeps going, the next check tries again
+                logger.exception(f'Checking for new lectures failed: {e!r}')
+                processed_lectures, failures = [], []
 
-    with EchoScraper(config, full_course_title, args.slice, headless=True) as scraper:
-        scraper.scrape_all_lectures()
-        lectures = scraper.lectures
+            if args.notify and (processed_lectures or failures or not args.watch):
+                if failures:
+                    message = f'{len(failures)} download(s) or merge(s) failed'
+                elif args.watch:
+                    message = f'{len(processed_lectures)} new lecture(s) downloaded'
+                else:
+                    message = 'Lectures downloaded successfully'
+                notification.notify(title='Echo Downloader', message=message, timeout=10)
 
-    asyncio.run(download_files_from_urls(args.output, lectures))
-    merge_files_concurrently(config, args.output, lectures)
+            if not args.watch_interval:
+                break
+            logger.info(f'Checking for new lectures again in {args.watch_interval} seconds')
+            time.sleep(args.watch_interval)
 
-    if args.notify:
-        notification.notify(
-            title='Echo Downloader',
-            message='Lectures downloaded successfully',
-            timeout=10
-        )
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
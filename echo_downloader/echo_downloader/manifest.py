@@ -0,0 +1,127 @@
+import os
+import sqlite3
+from datetime import datetime
+from types import TracebackType
+from typing import Self
+
+
+class DownloadManifest:
+    """
+    Persistent record of downloaded files and merged output files, keyed by the Echo360 lecture id.
+    Lets reruns skip finished work without sending a single request.
+    Also remembers the lectures of every course that watch mode has finished, so that only new ones are scraped.
+    With ``skip_finished`` disabled, work is still recorded, but nothing is reported as finished.
+    """
+
+    def __init__(self, database_path: str, *, skip_finished: bool = True):
+        self.database_path = database_path
+        self.skip_finished = skip_finished
+        self.__connection: sqlite3.Connection | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self.__connection is None:
+            raise RuntimeError(f"{self.__class__.__name__} must be used within a context manager.")
+        return self.__connection
+
+    def is_file_downloaded(self, lecture_id: str, file_name: str) -> bool:
+        if not self.skip_finished:
+            return False
+        row = self.connection.execute(
+            'SELECT local_path FROM files WHERE lecture_id = ? AND file_name = ?',
+            (lecture_id, file_name)
+        ).fetchone()
+        return row is not None and os.path.exists(row[0])
+
+    def record_file(self, lecture_id: str, file_name: str, *, url: str, size: int, etag: str, checksum: str | None,
+                    local_path: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO files (lecture_id, file_name, url, size, etag, checksum, local_path, completed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (lecture_id, file_name, url, size, etag, checksum, os.path.abspath(local_path),
+                 datetime.now().isoformat(timespec='seconds'))
+            )
+
+    def is_output_merged(self, lecture_id: str, output_path: str) -> bool:
+        if not self.skip_finished:
+            return False
+        output_path = os.path.abspath(output_path)
+        row = self.connection.execute(
+            'SELECT 1 FROM outputs WHERE lecture_id = ? AND output_path = ?',
+            (lecture_id, output_path)
+        ).fetchone()
+        return row is not None and os.path.exists(output_path)
+
+    def record_output(self, lecture_id: str, output_path: str, *, audio_file: str, video_file: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO outputs (lecture_id, output_path, audio_file, video_file, merged_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (lecture_id, os.path.abspath(output_path), audio_file, video_file,
+                 datetime.now().isoformat(timespec='seconds'))
+            )
+            self.connection.execute(
+                'UPDATE files SET output_path = ? WHERE lecture_id = ? AND file_name IN (?, ?)',
+                (os.path.abspath(output_path), lecture_id, audio_file, video_file)
+            )
+
+    def get_seen_lecture_ids(self, course_url: str) -> set[str]:
+        rows = self.connection.execute('SELECT lecture_id FROM seen_lectures WHERE course_url = ?', (course_url,))
+        return {lecture_id for lecture_id, in rows}
+
+    def record_seen_lectures(self, course_url: str, lecture_ids: list[str]) -> None:
+        seen_at = datetime.now().isoformat(timespec='seconds')
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO seen_lectures (course_url, lecture_id, seen_at) VALUES (?, ?, ?)',
+                [(course_url, lecture_id, seen_at) for lecture_id in lecture_ids]
+            )
+
+    def __enter__(self) -> Self:
+        os.makedirs(os.path.dirname(self.database_path), exist_ok=True)
+        self.__connection = sqlite3.connect(self.database_path)
+        self.__create_tables()
+        return self
+
+    def __exit__(self,
+                 exc_type: type[BaseException] | None,
+                 exc_val: BaseException | None,
+                 exc_tb: TracebackType | None) -> None:
+        self.connection.close()
+        self.__connection = None
+
+    def __create_tables(self) -> None:
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS files (
+                    lecture_id TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    etag TEXT NOT NULL,
+                    checksum TEXT,
+                    local_path TEXT NOT NULL,
+                    output_path TEXT,
+                    completed_at TEXT NOT NULL,
+                    PRIMARY KEY (lecture_id, file_name)
+                )
+            ''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS outputs (
+                    lecture_id TEXT NOT NULL,
+                    output_path TEXT NOT NULL,
+                    audio_file TEXT NOT NULL,
+                    video_file TEXT NOT NULL,
+                    merged_at TEXT NOT NULL,
+                    PRIMARY KEY (lecture_id, output_path)
+                )
+            ''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS seen_lectures (
+                    course_url TEXT NOT NULL,
+                    lecture_id TEXT NOT NULL,
+                    seen_at TEXT NOT NULL,
+                    PRIMARY KEY (course_url, lecture_id)
+                )
+            ''')
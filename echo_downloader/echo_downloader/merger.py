@@ -1,58 +1,422 @@
+import asyncio
+import contextlib
+import json
 import logging
 import os
 import subprocess
+import time
+from collections.abc import Iterable
+from dataclasses import asdict, dataclass
+from datetime import datetime
 from functools import partial
-from multiprocessing import Pool
 
 from .domain import Echo360Lecture
-from .config_wrapper import EchoDownloaderConfig
+from .config_wrapper import EchoDownloaderConfig, MergeEngine
+from .manifest import DownloadManifest
+from .remux import RemuxError, remux
+from .retry import DownloadFailure
 
 logger = logging.getLogger(__name__)
 
+# Merges running at the same time on one disk, when max_concurrent_merges leaves it to the disk
+ROTATIONAL_DISK_MERGES = 1
+SOLID_STATE_DISK_MERGES = 4
+UNKNOWN_DISK_MERGES = 2
+PROBE_TIMEOUT = 60
+# Seconds between the progress messages of a running merge
+PROGRESS_LOG_INTERVAL = 10
+MEGABYTE = 1024 * 1024
+
+
+@dataclass(slots=True)
+class MergeResult:
+    output_path: str
+    success: bool
+    error: str = ''
+    started_at: float = 0.0  # When the merge was started, as a timestamp
+    duration: float = 0.0  # Seconds the merge ran for
+    wait_time: float = 0.0  # Seconds spent waiting for a free slot of the disks
+    input_bytes: int = 0
+    output_bytes: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """
+        Bytes read per second.
+        """
+        return self.input_bytes / self.duration if self.duration > 0 else 0.0
+
+
+class MergeProgress:
+    """
+    Logs how much of a merge is done every ``PROGRESS_LOG_INTERVAL`` seconds.
+    A stream copy writes about as much as it reads, so the share of the input size written tells the progress.
+    """
+
+    def __init__(self, output_path: str, input_bytes: int):
+        self.output_path = output_path
+        self.input_bytes = input_bytes
+        self.__start_time = self.__last_log_time = time.monotonic()
+
+    def update(self, written_bytes: int) -> None:
+        if time.monotonic() - self.__last_log_time < PROGRESS_LOG_INTERVAL:
+            return
+
+        self.__last_log_time = time.monotonic()
+        throughput = written_bytes / (self.__last_log_time - self.__start_time) / MEGABYTE
+        percentage = f'{min(written_bytes / self.input_bytes, 1):.0%}, ' if self.input_bytes else ''
+        logger.info(f'Merging {os.path.basename(self.output_path)}: {percentage}'
+                    f'{written_bytes / MEGABYTE:.0f} MB written, {throughput:.1f} MB/s')
+
+
+class MergeExecutor:
+    """
+    Runs merges as asyncio subprocesses, limiting how many run at the same time per disk rather than per CPU,
+    as a stream copy is bound by the disk.
+    A merge takes a slot of the disk it writes to, and with ``per_device_queues`` also of the disk it reads from,
+    if that is another one.
+    """
+
+    def __init__(self, options: EchoDownloaderConfig.Merger):
+        self.options = options
+        self.__semaphores: dict[int, asyncio.Semaphore] = {}
+
+    async def merge(self, file_info: dict[str, str]) -> MergeResult:
+        devices = {get_device(file_info['output_path'])}
+        if self.options.per_device_queues:
+            devices |= {get_device(file_info['audio_path']), get_device(file_info['video_path'])}
+
+        queued_at = time.monotonic()
+        async with contextlib.AsyncExitStack() as stack:
+            # The slots are always taken in the same order, so merges waiting for two disks can't deadlock
+            for device in sorted(devices):
+                await stack.enter_async_context(self.__get_semaphore(device))
+            wait_time = time.monotonic() - queued_at
+            result = await merge_files(**file_info, engine=self.options.engine)
+
+        result.wait_time = wait_time
+        return result
+
+    def __get_semaphore(self, device: int) -> asyncio.Semaphore:
+        if device not in self.__semaphores:
+            limit = self.options.max_concurrent_merges or get_device_concurrency(device)
+            logger.debug(f'Running up to {limit} merge(s) at the same time on device {device}')
+            self.__semaphores[device] = asyncio.Semaphore(max(limit, 1))
+        return self.__semaphores[device]
+
 
 def merge_files_concurrently(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
-                             delete_originals: bool = True) -> None:
-    file_infos = get_file_infos(config, output_dir, lectures)
+                             delete_originals: bool = True, manifest: DownloadManifest | None = None) -> list[MergeResult]:
+    return asyncio.run(merge_lectures(config, output_dir, lectures, delete_originals, manifest))
+
+
+async def merge_lectures(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
+                         delete_originals: bool = True, manifest: DownloadManifest | None = None) -> list[MergeResult]:
+    lecture_file_infos = get_pending_file_infos(config, output_dir, lectures, manifest)
+    file_infos = [info for _, info in lecture_file_infos]
+
+    executor = MergeExecutor(config.merger)
+    results = await asyncio.gather(*(executor.merge(info) for info in file_infos))
 
-    with Pool() as pool:
-        list(pool.imap_unordered(merge_files_wrapper, file_infos))
+    if manifest is not None:
+        for (lecture, info), result in zip(lecture_file_infos, results):
+            if result.success:
+                record_merge(manifest, lecture, info)
 
+    log_merge_summary(results)
+    report_merge_metrics(config.merger, results)
     if delete_originals:
-        directories = set()
+        # The files of a failed merge are kept for the next run
+        delete_merge_inputs([info for info, result in zip(file_infos, results) if result.success],
+                            [info for info, result in zip(file_infos, results) if not result.success])
+    return results
 
-        for info in file_infos:
-            for key, path in info.items():
-                if key == 'output_path':
-                    continue
-                if os.path.exists(path):
-                    os.remove(path)
-                directories.add(os.path.dirname(path))
 
-        for directory in directories:
-            if not os.listdir(directory):
-                os.rmdir(directory)
+def get_pending_file_infos(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
+                           manifest: DownloadManifest | None = None) -> list[tuple[Echo360Lecture, dict[str, str]]]:
+    """
+    Get the merges of every lecture, leaving out the ones that are done already.
+    """
+    return [(lecture, info) for lecture in lectures for info in get_file_infos(config, output_dir, [lecture])
+            if not is_merge_done(lecture, info, manifest)]
 
 
-def merge_files_wrapper(file_info: dict[str, str]) -> None:
-    merge_files(**file_info)
+def is_merge_done(lecture: Echo360Lecture, file_info: dict[str, str], manifest: DownloadManifest | None = None) -> bool:
+    """
+    A merge is done once the manifest has recorded it, or once its output exists and is valid, e.g. when it was merged
+    by a run that didn't use the manifest. Such outputs are recorded, so that the next run doesn't have to probe them.
+    """
+    if manifest is not None and manifest.is_output_merged(lecture.lecture_id, file_info['output_path']):
+        return True
+    if not is_valid_output(file_info['output_path']):
+        return False
 
+    logger.info(f'Skipping {file_info["output_path"]}, it has been merged already')
+    if manifest is not None:
+        record_merge(manifest, lecture, file_info)
+    return True
 
-def merge_files(*, audio_path: str, video_path: str, output_path: str) -> None:
+
+def is_output_done(lecture: Echo360Lecture, output_path: str, manifest: DownloadManifest | None = None) -> bool:
+    """
+    Check whether the output has been merged, without recording it like ``is_merge_done`` does.
+    """
+    return (manifest is not None and manifest.is_output_merged(lecture.lecture_id, output_path)) or is_valid_output(
+        output_path)
+
+
+def record_merge(manifest: DownloadManifest, lecture: Echo360Lecture, file_info: dict[str, str]) -> None:
+    manifest.record_output(lecture.lecture_id, file_info['output_path'],
+                           audio_file=os.path.basename(file_info['audio_path']),
+                           video_file=os.path.basename(file_info['video_path']))
+
+
+def delete_merge_inputs(file_infos: list[dict[str, str]], kept_file_infos: Iterable[dict[str, str]] = ()) -> None:
+    """
+    Delete the audio and video files of the merges, along with the folders left empty.
+    Files that the merges of ``kept_file_infos`` also use are kept.
+    """
+    directories = set()
+    kept_paths = {path for info in kept_file_infos for key, path in info.items() if key != 'output_path'}
+
+    for info in file_infos:
+        for key, path in info.items():
+            if key == 'output_path' or path in kept_paths:
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+            directories.add(os.path.dirname(path))
+
+    for directory in directories:
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+
+
+async def merge_files(*, audio_path: str, video_path: str, output_path: str,
+                      engine: MergeEngine = 'ffmpeg') -> MergeResult:
+    """
+    Merge into a temporary file next to the output, which only replaces the output once it has been verified,
+    so that an interrupted merge never leaves a truncated output behind.
+    The native engine falls back to ffmpeg for files it can't remux.
+    """
+    temp_path = get_temp_path(output_path)
+    input_bytes = sum(os.path.getsize(path) for path in (audio_path, video_path) if os.path.exists(path))
+    result = MergeResult(output_path, False, started_at=time.time(), input_bytes=input_bytes)
+    progress = MergeProgress(output_path, input_bytes)
+    start_time = time.monotonic()
+
+    if engine == 'native':
+        try:
+            await asyncio.to_thread(remux, audio_path, video_path, temp_path, progress.update)
+        except RemuxError as e:
+            logger.warning(f'Failed to remux {output_path} natively ({e}), merging it with ffmpeg instead')
+            engine = 'ffmpeg'
+        except OSError as e:
+            result.error = f'failed to remux: {e!r}'
+    if engine == 'ffmpeg':
+        result.error = await run_ffmpeg(audio_path, video_path, temp_path, progress)
+    result.duration = time.monotonic() - start_time
+
+    if result.error:
+        remove_file(temp_path)
+        logger.error(f'Error while merging {output_path}, {result.error}')
+        return result
+
+    if not await asyncio.to_thread(is_valid_output, temp_path):
+        remove_file(temp_path)
+        result.error = 'the merged file is not valid'
+        logger.error(f'Error while merging {output_path}, {result.error}')
+        return result
+
+    result.output_bytes = os.path.getsize(temp_path)
+    os.replace(temp_path, output_path)
+    result.success = True
+    logger.info(f'Merging completed successfully! ({audio_path} + {video_path} => {output_path}) '
+                f'in {result.duration:.1f}s, {result.throughput / MEGABYTE:.1f} MB/s')
+    return result
+
+
+async def run_ffmpeg(audio_path: str, video_path: str, output_path: str, progress: MergeProgress) -> str:
+    """
+    Merge the files with ffmpeg, feeding the progress it reports to ``progress``.
+    Return what went wrong, or an empty string if ffmpeg succeeded.
+    """
     ffmpeg_cmd = [
         'ffmpeg',
+        '-nostdin',
+        '-y',
+        '-loglevel', 'error',
+        '-progress', 'pipe:1',
         '-i', audio_path,
         '-i', video_path,
         '-c:a', 'copy',
         '-c:v', 'copy',
+        '-f', 'mp4',
         output_path
     ]
 
     try:
-        process = subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        logger.info(f'Merging completed successfully! ({audio_path} + {video_path} => {output_path})')
-        logger.debug('Process:', process)
-    except subprocess.CalledProcessError as e:
-        logger.exception('Error while merging:', e)
+        process = await asyncio.create_subprocess_exec(*ffmpeg_cmd, stdin=subprocess.DEVNULL,
+                                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        return f'failed to start ffmpeg: {e!r}'
+
+    try:
+        stderr_task = asyncio.create_task(process.stderr.read())
+        await read_progress(process.stdout, progress)
+        await process.wait()
+        stderr = await stderr_task
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    if process.returncode == 0:
+        return ''
+    # With the log level at "error", the last line says what went wrong
+    error_lines = stderr.decode(errors='replace').strip().splitlines()
+    return f'ffmpeg exited with {process.returncode}' + (f': {error_lines[-1]}' if error_lines else '')
+
+
+async def read_progress(stdout: asyncio.StreamReader, progress: MergeProgress) -> None:
+    """
+    Read the ``key=value`` lines of ``-progress``, passing the number of bytes written to ``progress``.
+    """
+    written_bytes = 0
+
+    async for line in stdout:
+        key, _, value = line.decode(errors='replace').strip().partition('=')
+        if key == 'total_size' and value.isdigit():
+            written_bytes = int(value)
+        elif key == 'progress' and value == 'continue':
+            progress.update(written_bytes)
+
+
+def get_temp_path(output_path: str) -> str:
+    # In the same folder, so that renaming it to the output is atomic
+    directory, file_name = os.path.split(output_path)
+    return os.path.join(directory, f'.{file_name}.part')
+
+
+def remove_file(path: str) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def is_valid_output(path: str) -> bool:
+    """
+    Check with ffprobe that the file is a complete merge, with an audio and a video stream and a duration.
+    MP4 files get their index at the end, so a merge that was cut off can't be read at all.
+    Without ffprobe, any file that isn't empty is taken as valid.
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return False
+
+    ffprobe_cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type', '-of', 'json', path]
+    try:
+        process = subprocess.run(ffprobe_cmd, stdin=subprocess.DEVNULL, capture_output=True, timeout=PROBE_TIMEOUT)
+    except FileNotFoundError:
+        logger.debug(f'ffprobe was not found, not verifying {path}')
+        return True
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f'Failed to probe {path}: {e!r}')
+        return False
+
+    if process.returncode != 0:
+        return False
+    try:
+        probe = json.loads(process.stdout)
+        duration = float(probe['format']['duration'])
+        codec_types = {stream['codec_type'] for stream in probe['streams']}
+    except (ValueError, KeyError, TypeError):
+        return False
+
+    return duration > 0 and {'audio', 'video'} <= codec_types
+
+
+def log_merge_summary(results: list[MergeResult]) -> None:
+    failed_results = [result for result in results if not result.success]
+    if not failed_results:
+        return
+
+    logger.error(f'{len(failed_results)} of {len(results)} merge(s) failed:')
+    for result in failed_results:
+        logger.error(f'  {result.output_path}: {result.error}')
+
+
+def report_merge_metrics(options: EchoDownloaderConfig.Merger, results: list[MergeResult]) -> None:
+    """
+    Log the timing of the merge stage and its slowest merge, and append the metrics of every merge to
+    ``metrics_file`` as a line of JSON, for tuning the merge concurrency.
+    """
+    if not results:
+        return
+
+    stage_start = min(result.started_at - result.wait_time for result in results)
+    stage_time = max(result.started_at + result.duration for result in results) - stage_start
+    input_bytes = sum(result.input_bytes for result in results if result.success)
+    slowest = max(results, key=lambda result: result.duration)
+
+    logger.info(f'Merged {sum(result.success for result in results)} of {len(results)} file(s), '
+                f'{input_bytes / MEGABYTE:.0f} MB in {stage_time:.1f}s '
+                f'({input_bytes / stage_time / MEGABYTE if stage_time > 0 else 0:.1f} MB/s overall), '
+                f'waiting {sum(result.wait_time for result in results) / len(results):.1f}s for the disk on average')
+    logger.info(f'Slowest merge: {os.path.basename(slowest.output_path)} ({slowest.duration:.1f}s, '
+                f'{slowest.throughput / MEGABYTE:.1f} MB/s)')
+
+    if not options.metrics_file:
+        return
+
+    metrics = {
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+        'max_concurrent_merges': options.max_concurrent_merges,
+        'per_device_queues': options.per_device_queues,
+        'engine': options.engine,
+        'stage_time': stage_time,
+        'merges': [{**asdict(result), 'throughput': result.throughput} for result in results],
+    }
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(options.metrics_file)), exist_ok=True)
+        with open(options.metrics_file, 'a') as f:
+            f.write(json.dumps(metrics) + '\n')
+    except OSError as e:
+        logger.warning(f'Failed to write the merge metrics to {options.metrics_file}: {e!r}')
+
+
+def get_merge_failures(results: list[MergeResult]) -> list[DownloadFailure]:
+    """
+    Report the failed merges along with the failed downloads, so that they count as failures of the run.
+    """
+    return [DownloadFailure(f'merging {result.output_path}', result.error) for result in results if not result.success]
+
+
+def get_device(path: str) -> int:
+    """
+    Return the device of the path, or of its closest existing parent directory if it doesn't exist yet.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def get_device_concurrency(device: int) -> int:
+    """
+    Pick the number of merges for a disk by whether it is a spinning one, which Linux tells in sysfs.
+    """
+    if not hasattr(os, 'major'):
+        return UNKNOWN_DISK_MERGES
+
+    block_dir = f'/sys/dev/block/{os.major(device)}:{os.minor(device)}'
+    # A partition has no queue of its own, the queue of its disk is one level up
+    for queue_dir in (os.path.join(block_dir, 'queue'), os.path.join(block_dir, '..', 'queue')):
+        try:
+            with open(os.path.join(queue_dir, 'rotational')) as f:
+                return ROTATIONAL_DISK_MERGES if f.read().strip() == '1' else SOLID_STATE_DISK_MERGES
+        except OSError:
+            continue
+
+    return UNKNOWN_DISK_MERGES
 
 
 def get_file_infos(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture]) -> list[dict[str, str]]:
@@ -63,16 +427,31 @@ def get_file_infos(config: EchoDownloaderConfig, output_dir: str, lectures: list
         folder_join = partial(os.path.join, week_folder)
         file_names = {info.file_name for info in lecture.file_infos}
 
-        for title_suffix, av_pairs in config.file_pairs.items():
-            output_path = folder_join(lecture.encoded_title + title_suffix + '.mp4')
-
-            for audio, video in av_pairs:
-                if audio in file_names and video in file_names:
-                    kwargs = dict(audio_path=folder_join(f'lecture_{lecture.lecture_in_week}', audio),
-                                  video_path=folder_join(f'lecture_{lecture.lecture_in_week}', video),
-                                  output_path=output_path)
+        for title_suffix, (audio, video) in select_file_pairs(config, file_names).items():
+            kwargs = dict(audio_path=folder_join(f'lecture_{lecture.lecture_in_week}', audio),
+                          video_path=folder_join(f'lecture_{lecture.lecture_in_week}', video),
+                          output_path=get_output_path(output_dir, lecture, title_suffix))
 
-                    file_infos.append(kwargs)
-                    break
+            file_infos.append(kwargs)
 
     return file_infos
+
+
+def get_output_path(output_dir: str, lecture: Echo360Lecture, title_suffix: str) -> str:
+    return os.path.join(output_dir, lecture.encoded_course_name, f'week_{lecture.week_number}',
+                        lecture.encoded_title + title_suffix + '.mp4')
+
+
+def select_file_pairs(config: EchoDownloaderConfig, file_names: set[str]) -> dict[str, tuple[str, str]]:
+    """
+    Pick the most preferred available audio/video pair for every output file suffix.
+    """
+    selected = {}
+
+    for title_suffix, av_pairs in config.file_pairs.items():
+        for audio, video in av_pairs:
+            if audio in file_names and video in file_names:
+                selected[title_suffix] = (audio, video)
+                break
+
+    return selected
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass, field
+
+from .budget import DiskBudget, estimate_lecture_bytes
+from .config_wrapper import EchoDownloaderConfig
+from .domain import Echo360Lecture
+from .downloader import create_session, download_jobs, warm_up_session
+from .manifest import DownloadManifest
+from .merger import (MergeExecutor, MergeResult, delete_merge_inputs, get_merge_failures, get_pending_file_infos,
+                     log_merge_summary, record_merge, report_merge_metrics)
+from .planner import fetch_file_sizes, plan_lecture_files
+from .retry import DownloadFailure, Retrier
+from .scheduler import DownloadJob, create_download_jobs, group_jobs_by_lecture
+from .sink import WriterPool
+from .throttle import Throttle
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True, eq=False)
+class PendingMerge:
+    lecture: Echo360Lecture
+    file_info: dict[str, str]
+    missing_paths: set[str] = field(default_factory=set)
+    failed: bool = False
+
+
+async def download_and_merge(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
+                             manifest: DownloadManifest | None = None, delete_originals: bool = True) -> list[DownloadFailure]:
+    """
+    Download the files of the lectures and merge every audio/video pair as soon as both of its files are downloaded,
+    while the remaining downloads continue. Returns the downloads that failed for good.
+    With ``downloader.disk_budget``, a lecture is only started once its files and merges fit into the budget, and the
+    space is freed as soon as its merges are done, so a course of any length needs a bounded amount of space.
+    """
+    logger.info('Downloading and merging files...')
+    retrier = Retrier(config.downloader)
+
+    async with (create_session(config.downloader) as session, Throttle(config.downloader) as throttle,
+                WriterPool(config.downloader) as writers):
+        await warm_up_session(session)
+        await plan_lecture_files(config, session, lectures, output_dir, manifest)
+
+        jobs = create_download_jobs(config, output_dir, lectures, config.downloader.order, manifest)
+        job_paths = {os.path.abspath(job.destination_path) for job in jobs}
+
+        budget = DiskBudget(config.downloader.disk_budget)
+        if budget.limit > 0:
+            await fetch_file_sizes(session, [job.info for job in jobs])
+            # The downloads of a lecture waiting for space can only be behind the ones of the lectures already started,
+            # which then always finish and free their space
+            jobs = group_jobs_by_lecture(jobs)
+
+        merges = [PendingMerge(lecture, info) for lecture, info in get_pending_file_infos(config, output_dir, lectures, manifest)]
+        waiting_merges: dict[str, list[PendingMerge]] = {}
+        unfinished_merges: dict[int, list[PendingMerge]] = {}
+        lecture_merges: dict[int, list[PendingMerge]] = {}
+        unfinished_jobs: dict[int, list[DownloadJob]] = {}
+
+        for job in jobs:
+            unfinished_jobs.setdefault(id(job.lecture), []).append(job)
+        for merge in merges:
+            unfinished_merges.setdefault(id(merge.lecture), []).append(merge)
+            lecture_merges.setdefault(id(merge.lecture), []).append(merge)
+            for path in (merge.file_info['audio_path'], merge.file_info['video_path']):
+                if os.path.abspath(path) in job_paths:
+                    merge.missing_paths.add(os.path.abspath(path))
+                    waiting_merges.setdefault(os.path.abspath(path), []).append(merge)
+
+        lecture_bytes = {
+            lecture_id: estimate_lecture_bytes(lecture_jobs, [merge.file_info
+                                                              for merge in lecture_merges.get(lecture_id, [])])
+            for lecture_id, lecture_jobs in unfinished_jobs.items()
+        } if budget.limit > 0 else {}
+
+        async def reserve_space(job: DownloadJob) -> None:
+            await budget.reserve(id(job.lecture), lecture_bytes[id(job.lecture)], job.lecture.title)
+
+        def release_space(lecture: Echo360Lecture) -> None:
+            # The files of failed merges stay on disk, but no longer hold up the remaining lectures
+            if not unfinished_jobs.get(id(lecture)) and not unfinished_merges.get(id(lecture)):
+                budget.release(id(lecture))
+
+        merge_executor = MergeExecutor(config.merger)
+        merge_tasks: list[asyncio.Task[None]] = []
+        merge_results: list[MergeResult] = []
+
+        async def run_merge(merge: PendingMerge) -> None:
+            if merge.failed:
+                logger.error(f'Not merging {merge.file_info["output_path"]}, some of its files failed to download')
+            else:
+                result = await merge_executor.merge(merge.file_info)
+                merge_results.append(result)
+                merge.failed = not result.success
+                if result.success and manifest is not None:
+                    record_merge(manifest, merge.lecture, merge.file_info)
+
+            remaining_merges = unfinished_merges[id(merge.lecture)]
+            remaining_merges.remove(merge)
+            if not remaining_merges and delete_originals:
+                # The files of a failed merge are kept for the next run
+                finished_merges = lecture_merges[id(merge.lecture)]
+                delete_merge_inputs([finished.file_info for finished in finished_merges if not finished.failed],
+                                    [finished.file_info for finished in finished_merges if finished.failed])
+            release_space(merge.lecture)
+
+        def on_job_done(job: DownloadJob) -> None:
+            path = os.path.abspath(job.destination_path)
+            unfinished_jobs[id(job.lecture)].remove(job)
+
+            for merge in waiting_merges.pop(path, []):
+                merge.missing_paths.discard(path)
+                merge.failed |= not os.path.exists(path)
+                if not merge.missing_paths:
+                    merge_tasks.append(asyncio.create_task(run_merge(merge)))
+            release_space(job.lecture)
+
+        for merge in merges:
+            if not merge.missing_paths:
+                merge_tasks.append(asyncio.create_task(run_merge(merge)))
+
+        await download_jobs(session, throttle, retrier, writers, config.downloader, jobs, manifest, on_job_done,
+                            reserve_space if budget.limit > 0 else None)
+        logger.info('All files downloaded')
+        await asyncio.gather(*merge_tasks)
+
+    retrier.log_summary()
+    log_merge_summary(merge_results)
+    report_merge_metrics(config.merger, merge_results)
+    logger.info('All files merged')
+    return retrier.failures + get_merge_failures(merge_results)
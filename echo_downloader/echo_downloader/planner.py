@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import posixpath
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .config_wrapper import EchoDownloaderConfig
+from .domain import Echo360Lecture, FileInfo
+from .manifest import DownloadManifest
+from .merger import get_output_path, is_output_done
+
+logger = logging.getLogger(__name__)
+
+
+async def plan_lecture_files(config: EchoDownloaderConfig, session: aiohttp.ClientSession,
+                             lectures: list[Echo360Lecture], output_dir: str,
+                             manifest: DownloadManifest | None = None) -> None:
+    """
+    Narrow down the files of every lecture to the ones that end up in an output file that isn't merged yet.
+    """
+    await asyncio.gather(*(plan_files(config, session, lecture, output_dir, manifest)
+                           for lecture in lectures if lecture.file_infos))
+
+
+async def plan_files(config: EchoDownloaderConfig, session: aiohttp.ClientSession, lecture: Echo360Lecture,
+                     output_dir: str, manifest: DownloadManifest | None = None) -> None:
+    """
+    Resolve the ``file_pairs`` preference order of every output against the discovered files of the lecture.
+    A preferred file that wasn't discovered is looked for next to the discovered ones with a HEAD request,
+    if ``downloader.probe_missing_files`` is enabled.
+    Outputs that have been merged already are left out, so that reruns don't send any probes for them.
+    """
+    discovered = {info.file_name: info for info in lecture.file_infos}
+    probed: dict[str, FileInfo | None] = {}
+
+    async def resolve(file_name: str) -> FileInfo | None:
+        if file_name in discovered:
+            return discovered[file_name]
+        if not config.downloader.probe_missing_files:
+            return None
+        if file_name not in probed:
+            probed[file_name] = await probe_sibling_file(session, lecture, file_name)
+        return probed[file_name]
+
+    planned: dict[str, FileInfo] = {}
+    merged_suffixes = {title_suffix for title_suffix in config.file_pairs
+                       if is_output_done(lecture, get_output_path(output_dir, lecture, title_suffix), manifest)}
+
+    for title_suffix, av_pairs in config.file_pairs.items():
+        if title_suffix in merged_suffixes:
+            logger.debug(f'Not planning "{title_suffix}" of {lecture.title}, it has been merged already')
+            continue
+        for audio, video in av_pairs:
+            audio_info, video_info = await resolve(audio), await resolve(video)
+            if audio_info is not None and video_info is not None:
+                planned[audio] = audio_info
+                planned[video] = video_info
+                break
+        else:
+            logger.debug(f'No audio/video pair found for "{title_suffix}" of {lecture.title}')
+
+    skipped = discovered.keys() - planned.keys()
+    if skipped:
+        logger.debug(f'Not downloading {", ".join(sorted(skipped))} of {lecture.title}, no output file uses them')
+    if not planned and len(merged_suffixes) < len(config.file_pairs):
+        logger.warning(f'None of the file pairs are available for {lecture.title}')
+
+    lecture.file_infos = list(planned.values())
+
+
+async def probe_sibling_file(session: aiohttp.ClientSession, lecture: Echo360Lecture, file_name: str) -> FileInfo | None:
+    """
+    Look for the file in the folder of the lecture's discovered files, reusing their query string (the URL signature).
+    """
+    if not lecture.file_infos:
+        return None
+
+    url = get_sibling_url(lecture.file_infos[0].url, file_name)
+
+    try:
+        async with session.head(url, allow_redirects=True, timeout=60) as response:
+            if response.ok:
+                logger.debug(f'Found {file_name} of {lecture.title} by probing')
+                return FileInfo(file_name, url, size=get_content_length(response))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.debug(f'Failed to probe {url}: {e!r}')
+
+    return None
+
+
+async def fetch_file_sizes(session: aiohttp.ClientSession, file_infos: list[FileInfo]) -> None:
+    """
+    Fill in the sizes of the files that don't have one yet from the ``Content-Length`` of a HEAD request.
+    """
+    async def fetch_size(info: FileInfo) -> None:
+        try:
+            async with session.head(info.url, allow_redirects=True, timeout=60) as response:
+                if response.ok:
+                    info.size = get_content_length(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.debug(f'Failed to get the size of {info.url}: {e!r}')
+
+        if not info.size:
+            logger.warning(f'The size of {info.file_name} is unknown, it is left out of the disk budget')
+
+    await asyncio.gather(*(fetch_size(info) for info in file_infos if not info.size))
+
+
+def get_content_length(response: aiohttp.ClientResponse) -> int:
+    """
+    Return the ``Content-Length`` of the response, 0 if it is missing or malformed.
+    """
+    try:
+        return max(int(response.headers.get('Content-Length', 0)), 0)
+    except ValueError:
+        return 0
+
+
+def get_sibling_url(url: str, file_name: str) -> str:
+    """
+    Replace the file name in the path of the URL, keeping its query string.
+    """
+    parsed_url = urlparse(url)
+    return parsed_url._replace(path=posixpath.join(posixpath.dirname(parsed_url.path), file_name)).geturl()
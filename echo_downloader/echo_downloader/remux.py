@@ -0,0 +1,381 @@
+import heapq
+import mmap
+import struct
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from types import TracebackType
+from typing import BinaryIO, Self
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Flags of the tfhd box
+BASE_DATA_OFFSET_PRESENT = 0x000001
+SAMPLE_DESCRIPTION_INDEX_PRESENT = 0x000002
+DEFAULT_SAMPLE_DURATION_PRESENT = 0x000008
+# Flags of the trun box
+DATA_OFFSET_PRESENT = 0x000001
+FIRST_SAMPLE_FLAGS_PRESENT = 0x000004
+SAMPLE_DURATION_PRESENT = 0x000100
+SAMPLE_FIELDS = 0x000f00  # Duration, size, flags and composition time offset, 4 bytes each
+
+
+class RemuxError(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class Box:
+    type: bytes
+    start: int
+    payload_start: int
+    end: int
+
+
+@dataclass(slots=True)
+class Fragment:
+    """
+    A moof box with the media data after it, up to the end of the following mdat box.
+    The offsets of the fields to rewrite are relative to the start of the moof box.
+    """
+    start: int
+    moof_end: int
+    end: int
+    decode_time: int
+    duration: int
+    sequence_number_offset: int
+    track_id_offset: int
+    base_data_offset_offset: int | None
+    decode_time_offset: int | None
+    decode_time_size: int
+
+
+class TrackSource:
+    """
+    The audio or video track of a fragmented MP4 file, read through a memory map.
+    Only the boxes describing the track and its fragments are parsed, the media data is never read into memory.
+    """
+
+    def __init__(self, path: str, handler_type: bytes):
+        self.path = path
+        self.__file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as e:
+            self.__file.close()
+            raise RemuxError(f'{path} is empty') from e
+
+        try:
+            self.__read_header(handler_type)
+        except BaseException:
+            self.close()
+            raise
+
+    def __read_header(self, handler_type: bytes) -> None:
+        self.ftyp: Box | None = None
+        self.moov: Box | None = None
+        for box in iter_boxes(self.data, 0, len(self.data)):
+            if box.type == b'ftyp':
+                self.ftyp = box
+            elif box.type == b'moov':
+                self.moov = box
+                break
+        if self.moov is None:
+            raise RemuxError(f'{self.path} has no moov box')
+
+        self.mvhd = self.__find(self.moov, b'mvhd')
+        self.trak = next((trak for trak in iter_boxes(self.data, self.moov.payload_start, self.moov.end)
+                          if trak.type == b'trak' and self.__get_handler_type(trak) == handler_type), None)
+        if self.trak is None:
+            raise RemuxError(f'{self.path} has no {handler_type.decode()} track')
+
+        self.tkhd = self.__find(self.trak, b'tkhd')
+        self.track_id_offset = get_versioned_offset(self.data, self.tkhd, 8, 16)
+        self.track_id = read_uint(self.data, self.track_id_offset, 4)
+        mdhd = self.__find(self.__find(self.trak, b'mdia'), b'mdhd')
+        self.timescale = read_uint(self.data, get_versioned_offset(self.data, mdhd, 8, 16), 4)
+
+        mvex = find_box(self.data, self.moov, b'mvex')
+        if mvex is None:
+            raise RemuxError(f'{self.path} is not a fragmented MP4 file')
+        self.trex = next((box for box in iter_boxes(self.data, mvex.payload_start, mvex.end)
+                          if box.type == b'trex' and read_uint(self.data, box.payload_start + 4, 4) == self.track_id),
+                         None)
+        self.default_sample_duration = read_uint(self.data, self.trex.payload_start + 12, 4) if self.trex else 0
+
+    def fragments(self) -> Iterator[Fragment]:
+        moof: Box | None = None
+        decode_time = 0
+
+        for box in iter_boxes(self.data, self.moov.end, len(self.data)):
+            if box.type == b'moof':
+                moof = box
+            elif box.type == b'mdat' and moof is not None:
+                fragment = self.__read_fragment(moof, box.end, decode_time)
+                decode_time = fragment.decode_time + fragment.duration
+                moof = None
+                yield fragment
+
+    def get_time_range(self) -> tuple[int, int]:
+        """
+        Return the decode time of the first sample and the end of the last one, in the timescale of the track.
+        """
+        start, end = None, 0
+        for fragment in self.fragments():
+            if start is None:
+                start = fragment.decode_time
+            end = max(end, fragment.decode_time + fragment.duration)
+
+        if start is None:
+            raise RemuxError(f'{self.path} has no fragments')
+        return start, end
+
+    def __read_fragment(self, moof: Box, end: int, decode_time: int) -> Fragment:
+        mfhd = self.__find(moof, b'mfhd')
+        trafs = [box for box in iter_boxes(self.data, moof.payload_start, moof.end) if box.type == b'traf']
+        if len(trafs) != 1:
+            raise RemuxError(f'Fragments with {len(trafs)} tracks are not supported ({self.path})')
+
+        tfhd = self.__find(trafs[0], b'tfhd')
+        flags = read_uint(self.data, tfhd.payload_start + 1, 3)
+        if read_uint(self.data, tfhd.payload_start + 4, 4) != self.track_id:
+            raise RemuxError(f'A fragment of {self.path} belongs to another track')
+
+        position = tfhd.payload_start + 8
+        base_data_offset_position = None
+        if flags & BASE_DATA_OFFSET_PRESENT:
+            base_data_offset_position = position
+            position += 8
+        if flags & SAMPLE_DESCRIPTION_INDEX_PRESENT:
+            position += 4
+        default_duration = self.default_sample_duration
+        if flags & DEFAULT_SAMPLE_DURATION_PRESENT:
+            default_duration = read_uint(self.data, position, 4)
+
+        tfdt = find_box(self.data, trafs[0], b'tfdt')
+        decode_time_size = 8 if tfdt is not None and self.data[tfdt.payload_start] == 1 else 4
+        if tfdt is not None:
+            decode_time = read_uint(self.data, tfdt.payload_start + 4, decode_time_size)
+
+        duration = 0
+        for trun in iter_boxes(self.data, trafs[0].payload_start, trafs[0].end):
+            if trun.type == b'trun':
+                duration += self.__get_run_duration(trun, default_duration)
+
+        return Fragment(moof.start, moof.end, end, decode_time, duration,
+                        sequence_number_offset=mfhd.payload_start + 4 - moof.start,
+                        track_id_offset=tfhd.payload_start + 4 - moof.start,
+                        base_data_offset_offset=(base_data_offset_position - moof.start
+                                                 if base_data_offset_position is not None else None),
+                        decode_time_offset=tfdt.payload_start + 4 - moof.start if tfdt is not None else None,
+                        decode_time_size=decode_time_size)
+
+    def __get_run_duration(self, trun: Box, default_duration: int) -> int:
+        flags = read_uint(self.data, trun.payload_start + 1, 3)
+        sample_count = read_uint(self.data, trun.payload_start + 4, 4)
+        if not flags & SAMPLE_DURATION_PRESENT:
+            return sample_count * default_duration
+
+        position = trun.payload_start + 8
+        if flags & DATA_OFFSET_PRESENT:
+            position += 4
+        if flags & FIRST_SAMPLE_FLAGS_PRESENT:
+            position += 4
+        # The duration is the first field of every sample
+        sample_size = 4 * (flags & SAMPLE_FIELDS).bit_count()
+        if position + sample_count * sample_size > trun.end:
+            raise RemuxError(f'A trun box of {self.path} is truncated')
+        return sum(read_uint(self.data, position + i * sample_size, 4) for i in range(sample_count))
+
+    def __get_handler_type(self, trak: Box) -> bytes | None:
+        mdia = find_box(self.data, trak, b'mdia')
+        hdlr = find_box(self.data, mdia, b'hdlr') if mdia is not None else None
+        return bytes(self.data[hdlr.payload_start + 8:hdlr.payload_start + 12]) if hdlr is not None else None
+
+    def __find(self, parent: Box, box_type: bytes) -> Box:
+        box = find_box(self.data, parent, box_type)
+        if box is None:
+            raise RemuxError(f'{self.path} has no {box_type.decode()} box in {parent.type.decode()}')
+        return box
+
+    def close(self) -> None:
+        self.data.close()
+        self.__file.close()
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self,
+                 exc_type: type[BaseException] | None,
+                 exc_val: BaseException | None,
+                 exc_tb: TracebackType | None) -> None:
+        self.close()
+
+
+def remux(audio_path: str, video_path: str, output_path: str,
+          on_progress: Callable[[int], None] | None = None) -> None:
+    """
+    Merge the audio track of one fragmented MP4 file (such as an .m4s stream) and the video track of another into
+    a fragmented MP4 file, with the moov box at the front (fast start) and the fragments of the two tracks interleaved
+    by decode time.
+    The fragments are copied as they are, only the track ids, sequence numbers, decode times and absolute offsets in
+    their moof boxes are rewritten, so memory use doesn't depend on the size of the files.
+    Like ffmpeg does with its inputs, every track is shifted to start at 0.
+    ``on_progress`` is called with the number of bytes written after every fragment.
+    """
+    with TrackSource(audio_path, b'soun') as audio, TrackSource(video_path, b'vide') as video:
+        # The audio track comes first, like in the files ffmpeg merges
+        sources = [audio, video]
+        time_ranges = [source.get_time_range() for source in sources]
+
+        with open(output_path, 'wb') as output:
+            output.write(bytes(video.data[video.ftyp.start:video.ftyp.end]) if video.ftyp else make_ftyp())
+            output.write(build_moov(sources, time_ranges))
+
+            fragments = heapq.merge(*(get_timed_fragments(source, track_index, start)
+                                      for track_index, (source, (start, _)) in enumerate(zip(sources, time_ranges))),
+                                    key=lambda item: item[:2])
+
+            for sequence_number, (_, track_index, fragment) in enumerate(fragments, 1):
+                write_fragment(output, sources[track_index], fragment, sequence_number, track_index + 1,
+                               time_ranges[track_index][0])
+                if on_progress is not None:
+                    on_progress(output.tell())
+
+
+def get_timed_fragments(source: TrackSource, track_index: int,
+                        start: int) -> Iterator[tuple[float, int, Fragment]]:
+    for fragment in source.fragments():
+        yield (fragment.decode_time - start) / source.timescale, track_index, fragment
+
+
+def build_moov(sources: list[TrackSource], time_ranges: list[tuple[int, int]]) -> bytes:
+    """
+    Build a moov box with the tracks of the sources, numbered from 1, and an mvex box declaring the fragments,
+    using the mvhd box of the last source (the video) with the duration of the longest track.
+    The durations of the tracks are converted to the timescale of that mvhd box.
+    """
+    video = sources[-1]
+    mvhd = bytearray(video.data[video.mvhd.start:video.mvhd.end])
+    version = mvhd[video.mvhd.payload_start - video.mvhd.start]
+    timescale_offset = get_versioned_offset(video.data, video.mvhd, 8, 16) - video.mvhd.start
+    movie_timescale = read_uint(mvhd, timescale_offset, 4)
+    track_durations = [round((end - start) / source.timescale * movie_timescale)
+                       for source, (start, end) in zip(sources, time_ranges)]
+    movie_duration = max(track_durations)
+
+    if version == 1:
+        struct.pack_into('>Q', mvhd, timescale_offset + 4, movie_duration)
+    else:
+        struct.pack_into('>I', mvhd, timescale_offset + 4, min(movie_duration, 0xffffffff))
+    # The next track id is the last field of mvhd
+    struct.pack_into('>I', mvhd, len(mvhd) - 4, len(sources) + 1)
+
+    traks = bytearray()
+    trexes = bytearray()
+    for track_id, (source, duration) in enumerate(zip(sources, track_durations), 1):
+        traks += build_trak(source, track_id, duration)
+
+        if source.trex is not None:
+            trex = bytearray(source.data[source.trex.start:source.trex.end])
+            struct.pack_into('>I', trex, source.trex.payload_start + 4 - source.trex.start, track_id)
+        else:
+            trex = make_full_box(b'trex', 0, 0, struct.pack('>5I', track_id, 1, 0, 0, 0))
+        trexes += trex
+
+    mvex = make_box(b'mvex', make_full_box(b'mehd', 1, 0, struct.pack('>Q', movie_duration)) + trexes)
+    return make_box(b'moov', mvhd + traks + mvex)
+
+
+def build_trak(source: TrackSource, track_id: int, duration: int) -> bytes:
+    """
+    Copy the trak box of the source with a new track id and its duration in the timescale of the output movie.
+    The edit list is left out, it is in the timescale of the source movie and refers to the timestamps from before
+    the track was shifted to start at 0.
+    """
+    children = bytearray()
+    for box in iter_boxes(source.data, source.trak.payload_start, source.trak.end):
+        if box.type == b'edts':
+            continue
+
+        child = bytearray(source.data[box.start:box.end])
+        if box.type == b'tkhd':
+            track_id_offset = source.track_id_offset - box.start
+            struct.pack_into('>I', child, track_id_offset, track_id)
+            # The duration follows the track id and a reserved field
+            if child[box.payload_start - box.start] == 1:
+                struct.pack_into('>Q', child, track_id_offset + 8, duration)
+            else:
+                struct.pack_into('>I', child, track_id_offset + 8, min(duration, 0xffffffff))
+        children += child
+
+    return make_box(b'trak', children)
+
+
+def write_fragment(output: BinaryIO, source: TrackSource, fragment: Fragment, sequence_number: int, track_id: int,
+                   start: int) -> None:
+    moof = bytearray(source.data[fragment.start:fragment.moof_end])
+    struct.pack_into('>I', moof, fragment.sequence_number_offset, sequence_number)
+    struct.pack_into('>I', moof, fragment.track_id_offset, track_id)
+    if fragment.decode_time_offset is not None:
+        moof[fragment.decode_time_offset:fragment.decode_time_offset + fragment.decode_time_size] = (
+            (fragment.decode_time - start).to_bytes(fragment.decode_time_size, 'big'))
+    if fragment.base_data_offset_offset is not None:
+        # An absolute offset in the source file, moved along with the fragment
+        base_data_offset = read_uint(moof, fragment.base_data_offset_offset, 8)
+        struct.pack_into('>Q', moof, fragment.base_data_offset_offset,
+                         base_data_offset - fragment.start + output.tell())
+    output.write(moof)
+
+    with memoryview(source.data) as view:
+        for position in range(fragment.moof_end, fragment.end, COPY_CHUNK_SIZE):
+            output.write(view[position:min(position + COPY_CHUNK_SIZE, fragment.end)])
+
+
+def iter_boxes(data: mmap.mmap | bytes | bytearray, start: int, end: int) -> Iterator[Box]:
+    position = start
+    while position + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, position)
+        header_size = 8
+        if size == 1:
+            if position + 16 > end:
+                raise RemuxError(f'Truncated header of the {box_type!r} box at {position}')
+            size = read_uint(data, position + 8, 8)
+            header_size = 16
+        elif size == 0:
+            # The box extends to the end of its parent
+            size = end - position
+
+        if size < header_size or position + size > end:
+            raise RemuxError(f'Invalid size of the {box_type!r} box at {position}')
+        yield Box(box_type, position, position + header_size, position + size)
+        position += size
+
+
+def find_box(data: mmap.mmap | bytes | bytearray, parent: Box, box_type: bytes) -> Box | None:
+    return next((box for box in iter_boxes(data, parent.payload_start, parent.end) if box.type == box_type), None)
+
+
+def get_versioned_offset(data: mmap.mmap | bytes | bytearray, box: Box, version_0_skip: int,
+                         version_1_skip: int) -> int:
+    """
+    Return the offset of the field after the creation and modification times of a full box, whose size depends on
+    the version of the box.
+    """
+    skip = version_1_skip if data[box.payload_start] == 1 else version_0_skip
+    return box.payload_start + 4 + skip
+
+
+def read_uint(data: mmap.mmap | bytes | bytearray, position: int, size: int) -> int:
+    return int.from_bytes(data[position:position + size], 'big')
+
+
+def make_box(box_type: bytes, payload: bytes | bytearray) -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def make_full_box(box_type: bytes, version: int, flags: int, payload: bytes | bytearray) -> bytes:
+    return make_box(box_type, struct.pack('>I', version << 24 | flags) + payload)
+
+
+def make_ftyp() -> bytes:
+    return make_box(b'ftyp', b'isom' + struct.pack('>I', 0x200) + b'isomiso6mp41')
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import random
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+from typing import TypeVar
+
+import aiohttp
+
+from .config_wrapper import EchoDownloaderConfig
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Statuses that mean the server is overloaded or briefly unavailable. Anything else, such as 403 for an expired
+# signature or 404, won't change by asking again.
+RETRIABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+@dataclass(slots=True)
+class DownloadFailure:
+    description: str
+    error: str
+
+
+class Retrier:
+    """
+    Runs operations with exponential backoff and full jitter, within a retry budget shared by the whole run.
+    Operations that fail for good are collected in ``failures``.
+    """
+
+    def __init__(self, options: EchoDownloaderConfig.Downloader):
+        self.max_attempts = max(options.max_attempts, 1)
+        self.base_delay = options.retry_base_delay
+        self.max_delay = options.retry_max_delay
+        self.remaining_budget = options.retry_budget
+        self.failures: list[DownloadFailure] = []
+
+    async def run(self, operation: Callable[[], Awaitable[T]], description: str) -> T | None:
+        """
+        Run the operation until it succeeds, returning its result, or None once it has failed for good.
+        Local errors, such as a full disk, fail for good at once.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await operation()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                if not is_retriable(e):
+                    reason = 'not retriable'
+                elif attempt == self.max_attempts:
+                    reason = f'gave up after {attempt} attempts'
+                elif self.remaining_budget <= 0:
+                    reason = 'retry budget exhausted'
+                else:
+                    self.remaining_budget -= 1
+                    delay = self.get_delay(attempt, e)
+                    logger.warning(f'Attempt {attempt} of {description} failed ({e!r}), retrying in {delay:.1f}s')
+                    await asyncio.sleep(delay)
+                    continue
+            except OSError as e:
+                error = e
+                reason = 'local error, not retriable'
+
+            logger.error(f'Failed to download {description}: {error!r} ({reason})')
+            self.failures.append(DownloadFailure(description, f'{error!r} ({reason})'))
+            return None
+
+    def get_delay(self, attempt: int, error: BaseException) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+        if isinstance(error, aiohttp.ClientResponseError) and error.headers is not None:
+            retry_after = error.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, min(float(retry_after), self.max_delay))
+
+        return delay
+
+    def log_summary(self) -> None:
+        if not self.failures:
+            return
+
+        logger.error(f'{len(self.failures)} download(s) failed:')
+        for failure in self.failures:
+            logger.error(f'  {failure.description}: {failure.error}')
+
+
+def is_retriable(error: BaseException) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRIABLE_STATUSES
+    # Connection errors, broken payloads and timeouts
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
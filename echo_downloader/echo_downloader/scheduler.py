@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
+
+from .config_wrapper import DownloadOrder, EchoDownloaderConfig
+from .domain import Echo360Lecture, FileInfo
+from .manifest import DownloadManifest
+from .merger import get_file_infos, is_merge_done, select_file_pairs
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True, eq=False)
+class DownloadJob:
+    lecture: Echo360Lecture
+    info: FileInfo
+    destination_path: str
+    priority: tuple[int, ...] = ()
+
+
+def create_download_jobs(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
+                         order: DownloadOrder, manifest: DownloadManifest | None = None) -> list[DownloadJob]:
+    """
+    Create a download job for every file of the lectures, sorted by priority (most urgent first).
+    Files that the manifest shows are no longer needed are left out.
+    """
+    jobs = []
+    lecture_ranks = rank_lectures(lectures, order)
+
+    for lecture in lectures:
+        if not lecture.file_infos:
+            continue
+
+        folder = os.path.join(output_dir, lecture.encoded_course_name, f'week_{lecture.week_number}', f'lecture_{lecture.lecture_in_week}')
+        file_tiers = rank_files(config, lecture)
+
+        for file_index, info in enumerate(lecture.file_infos):
+            if info.url is None:
+                continue
+            destination_path = os.path.join(folder, info.file_name)
+            info.local_path = os.path.abspath(destination_path)
+
+            if manifest is not None and not is_download_needed(config, output_dir, lecture, info, manifest):
+                logger.debug(f'Skipping {info.file_name} of {lecture.title}, the manifest shows it is no longer needed')
+                continue
+
+            os.makedirs(folder, exist_ok=True)
+
+            if order == 'pairs':
+                priority = (file_tiers[info.file_name], lecture_ranks[id(lecture)], file_index)
+            else:
+                priority = (lecture_ranks[id(lecture)], file_tiers[info.file_name], file_index)
+
+            jobs.append(DownloadJob(lecture, info, destination_path, priority))
+
+    jobs.sort(key=lambda job: job.priority)
+    return jobs
+
+
+def group_jobs_by_lecture(jobs: list[DownloadJob]) -> list[DownloadJob]:
+    """
+    Reorder the jobs so that the jobs of every lecture follow each other, keeping the lectures in the order of their
+    most urgent job.
+    """
+    lecture_ranks: dict[int, int] = {}
+    for job in jobs:
+        lecture_ranks.setdefault(id(job.lecture), len(lecture_ranks))
+
+    return sorted(jobs, key=lambda job: lecture_ranks[id(job.lecture)])
+
+
+def is_download_needed(config: EchoDownloaderConfig, output_dir: str, lecture: Echo360Lecture, info: FileInfo,
+                       manifest: DownloadManifest) -> bool:
+    """
+    A file isn't needed once it has been downloaded, or once every output file made from it has been merged
+    (by this tool or any other, an existing valid output counts as merged).
+    Files that no output is made from are needed until all the lecture's outputs have been merged.
+    """
+    if manifest.is_file_downloaded(lecture.lecture_id, info.file_name):
+        return False
+
+    merge_infos = get_file_infos(config, output_dir, [lecture])
+    if not merge_infos:
+        return True
+
+    users = [merge_info for merge_info in merge_infos
+             if info.file_name in (os.path.basename(merge_info['audio_path']), os.path.basename(merge_info['video_path']))]
+
+    return not all(is_merge_done(lecture, merge_info, manifest) for merge_info in users or merge_infos)
+
+
+def rank_lectures(lectures: list[Echo360Lecture], order: DownloadOrder) -> dict[int, int]:
+    """
+    Map the id of every lecture to its position in the download order.
+    """
+    if order in ('newest', 'oldest'):
+        ordered = sorted(lectures, key=lambda lecture: (lecture.date, lecture.start_time), reverse=order == 'newest')
+    else:
+        ordered = lectures
+
+    return {id(lecture): rank for rank, lecture in enumerate(ordered)}
+
+
+def rank_files(config: EchoDownloaderConfig, lecture: Echo360Lecture) -> dict[str, int]:
+    """
+    Map every file of the lecture to the index of the first output file it is needed for.
+    Files that aren't part of any output are ranked last.
+    """
+    file_names = [info.file_name for info in lecture.file_infos]
+    selected_pairs = list(select_file_pairs(config, set(file_names)).values())
+    tiers = {}
+
+    for file_name in file_names:
+        tiers[file_name] = next((tier for tier, pair in enumerate(selected_pairs) if file_name in pair),
+                                len(selected_pairs))
+
+    return tiers
+
+
+async def run_download_jobs(jobs: list[DownloadJob], download: Callable[[DownloadJob], Awaitable[None]],
+                            concurrency: int) -> None:
+    """
+    Run the jobs in their order with at most ``concurrency`` of them in progress at the same time.
+    """
+    queue: asyncio.Queue[DownloadJob] = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+
+    async def worker() -> None:
+        while not queue.empty():
+            job = queue.get_nowait()
+            try:
+                await download(job)
+            except Exception as e:
+                logger.exception(f'Unexpected error while downloading {job.info.url}: {e}')
+
+    await asyncio.gather(*(worker() for _ in range(max(min(concurrency, len(jobs)), 1))))
@@ -0,0 +1,155 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime as dt
+from typing import Any
+from urllib.parse import parse_qs, urlparse
+
+from .config_wrapper import EchoDownloaderConfig
+from .domain import Echo360Lecture, FileInfo
+
+logger = logging.getLogger(__name__)
+
+
+class ScrapeCache:
+    """
+    Remembers the lectures of courses and the file URLs of lectures between runs, one JSON file per course URL.
+    The lecture list is reused for ``lecture_list_ttl`` seconds. File URLs are reused until their signature expires,
+    or for ``file_urls_ttl`` seconds if they aren't signed, but not if they expire within ``url_expiry_margin`` seconds,
+    so that there is time left to download them.
+    With ``read_lecture_lists`` disabled, lecture lists are always scraped again (but still stored).
+    """
+
+    def __init__(self, cache_dir: str, options: EchoDownloaderConfig.Scraper, *, read: bool = True,
+                 read_lecture_lists: bool = True):
+        self.cache_dir = cache_dir
+        self.options = options
+        self.read = read
+        self.read_lecture_lists = read_lecture_lists
+
+    def load_lectures(self, course_url: str, row_limit: int | None = None) -> list[Echo360Lecture] | None:
+        """
+        Return the cached lectures, unless only the first rows of the course were read and ``row_limit``
+        (None for all rows) needs more of them.
+        """
+        course = self.__load(course_url) if self.read_lecture_lists else None
+        if course is None or time.time() - course['scraped_at'] > self.options.lecture_list_ttl:
+            return None
+
+        cached_row_limit = course.get('row_limit')
+        # A list shorter than its row limit has all rows of the course
+        if (cached_row_limit is not None and len(course['lectures']) >= cached_row_limit
+                and (row_limit is None or row_limit > cached_row_limit)):
+            logger.debug(f'The cached list of {course_url} has only the first {cached_row_limit} lectures')
+            return None
+
+        lectures = []
+        for item in course['lectures']:
+            lecture = Echo360Lecture()
+            lecture.date = dt.fromisoformat(item['date'])
+            lecture.start_time = dt.fromisoformat(item['start_time'])
+            lecture.end_time = dt.fromisoformat(item['end_time'])
+            lecture.course_name = item['course_name']
+            lecture.lecture_id = item['lecture_id']
+            lecture.url = item['url']
+            lectures.append(lecture)
+
+        logger.info(f'Using the cached list of {len(lectures)} lectures')
+        return lectures
+
+    def store_lectures(self, course_url: str, lectures: list[Echo360Lecture], row_limit: int | None = None) -> None:
+        """
+        Store the lectures as scraped, before they are numbered (numbering may change their course name).
+        ``row_limit`` is the number of rows that were read, if not all of them were.
+        """
+        course = self.__load(course_url, ignore_read=True) or {'files': {}}
+        course['scraped_at'] = time.time()
+        course['row_limit'] = row_limit
+        course['lectures'] = [{
+            'date': lecture.date.isoformat(),
+            'start_time': lecture.start_time.isoformat(),
+            'end_time': lecture.end_time.isoformat(),
+            'course_name': lecture.course_name,
+            'lecture_id': lecture.lecture_id,
+            'url': lecture.url,
+        } for lecture in lectures]
+        self.__save(course_url, course)
+
+    def load_file_infos(self, course_url: str, lecture_id: str) -> list[FileInfo] | None:
+        course = self.__load(course_url)
+        if course is None or lecture_id not in course['files']:
+            return None
+
+        entry = course['files'][lecture_id]
+        deadline = time.time() + self.options.url_expiry_margin
+        for file in entry['files']:
+            expires_at = get_url_expiry(file['url']) or entry['scraped_at'] + self.options.file_urls_ttl
+            if expires_at <= deadline:
+                return None
+
+        return [FileInfo(file['file_name'], file['url']) for file in entry['files']]
+
+    def store_file_infos(self, course_url: str, lectures: list[Echo360Lecture]) -> None:
+        course = self.__load(course_url, ignore_read=True) or {'scraped_at': 0, 'lectures': [], 'files': {}}
+        for lecture in lectures:
+            if lecture.file_infos:
+                course['files'][lecture.lecture_id] = {
+                    'scraped_at': time.time(),
+                    'files': [{'file_name': info.file_name, 'url': info.url} for info in lecture.file_infos],
+                }
+        self.__save(course_url, course)
+
+    def drop_file_infos(self, course_url: str, lecture_id: str) -> None:
+        course = self.__load(course_url, ignore_read=True)
+        if course is not None and course['files'].pop(lecture_id, None) is not None:
+            self.__save(course_url, course)
+
+    def __get_path(self, course_url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(course_url.encode()).hexdigest()[:16] + '.json')
+
+    def __load(self, course_url: str, *, ignore_read: bool = False) -> dict[str, Any] | None:
+        if not self.read and not ignore_read:
+            return None
+
+        try:
+            with open(self.__get_path(course_url)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring the unreadable scrape cache of {course_url}: {e!r}')
+            return None
+
+    def __save(self, course_url: str, course: dict[str, Any]) -> None:
+        path = self.__get_path(course_url)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(course, f)
+        os.replace(path + '.tmp', path)
+
+
+def get_url_expiry(url: str) -> float | None:
+    """
+    Return the time a signed URL expires at, for CloudFront (canned and custom policies) and S3 signatures.
+    """
+    query = {key: values[0] for key, values in parse_qs(urlparse(url).query).items()}
+
+    try:
+        if 'Expires' in query:
+            return float(query['Expires'])
+        if 'Policy' in query:
+            # CloudFront replaces the characters of base64 that aren't safe in URLs
+            encoded_policy = query['Policy'].translate(str.maketrans('-_~', '+=/'))
+            policy = json.loads(base64.b64decode(encoded_policy))
+            return float(policy['Statement'][0]['Condition']['DateLessThan']['AWS:EpochTime'])
+        if 'X-Amz-Date' in query and 'X-Amz-Expires' in query:
+            signed_at = dt.strptime(query['X-Amz-Date'], '%Y%m%dT%H%M%S%z')
+            return signed_at.timestamp() + float(query['X-Amz-Expires'])
+    except (KeyError, IndexError, TypeError, ValueError, binascii.Error) as e:
+        logger.debug(f'Failed to read the expiry time of {url}: {e!r}')
+
+    return None
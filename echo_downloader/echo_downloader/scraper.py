@@ -1,10 +1,17 @@
+import base64
 import json
 import logging
 import os
+import queue
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
 import time
 from collections import defaultdict
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from types import TracebackType
 from typing import Any, Self
@@ -12,16 +19,58 @@ from urllib.parse import urlparse
 
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.wait import WebDriverWait
 
+from .cdp import CdpDriver
 from .config_wrapper import EchoDownloaderConfig
 from .domain import Echo360Lecture, FileInfo
+from .merger import select_file_pairs
+from .scrape_cache import ScrapeCache
 
 logger = logging.getLogger(__name__)
 
+type Driver = WebDriver | CdpDriver
+
+# Manifests of the player list the streams a lecture offers, by names like "s0q1.m3u8" or "s0q1.m4s"
+MANIFEST_EXTENSIONS = ('.m3u8', '.mpd')
+STREAM_NAME_PATTERN = re.compile(r'\b(s\d+q\d+)\.\w+')
+# Seconds to wait for further manifests after the last one, as every video source may have a manifest of its own
+MANIFEST_SETTLE_TIME = 0.5
+POLL_INTERVAL = 0.1
+NETWORK_METHODS = ('Network.requestWillBeSent', 'Network.responseReceived')
+# Autoplay stays enabled, the player only requests its manifests and streams once playback starts
+LOW_FOOTPRINT_ARGUMENTS = ('--mute-audio', '--disable-gpu', '--disable-extensions', '--disable-background-networking',
+                           '--disable-default-apps', '--disable-sync', '--no-first-run',
+                           '--blink-settings=imagesEnabled=false')
+
+# Reads the date, time and id of every lecture row, finding the date and time elements like Selenium would
+READ_LECTURE_ROWS_SCRIPT = '''
+const [rows, dateLocator, timeLocator, idAttribute, limit] = arguments;
+
+function find(root, [strategy, value]) {
+    switch (strategy) {
+        case 'css selector': return root.querySelector(value);
+        case 'xpath': return document.evaluate(
+            value, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        case 'class name': return root.getElementsByClassName(value)[0] ?? null;
+        case 'tag name': return root.getElementsByTagName(value)[0] ?? null;
+        case 'id': return root.querySelector('#' + CSS.escape(value));
+        case 'name': return root.querySelector(`[name="${CSS.escape(value)}"]`);
+        default: throw new Error(`Unsupported locator strategy for lecture rows: ${strategy}`);
+    }
+}
+
+return rows.slice(0, limit ?? rows.length).map(row => ({
+    date: find(row, dateLocator)?.innerText.trim() ?? '',
+    time: find(row, timeLocator)?.innerText.trim() ?? '',
+    lecture_id: row.getAttribute(idAttribute),
+}));
+'''
+
 
 class EchoScraper:
     def __init__(self,
@@ -29,32 +78,157 @@ class EchoScraper:
                  course_title: str,
                  lecture_indices: slice,
                  *,
-                 headless: bool = True):
+                 headless: bool = True,
+                 cache: ScrapeCache | None = None,
+                 skipped_lecture_ids: set[str] | None = None,
+                 since: dt | None = None,
+                 until: dt | None = None):
         self.config = configuration
-        self.course_title = course_title
         self.lecture_indices = lecture_indices
         self.headless = headless
-
+        self.cache = cache
+        self.since = since
+        self.until = until
+
+        self.__driver: Driver | None = None
+        self.__pool_drivers: list[Driver] = []
+        self.__in_context = False
+        self.__profile_dirs: dict[int, str] = {}
+        self.__attached_drivers: set[int] = set()
+        self.select_course(course_title, skipped_lecture_ids)
+
+    def select_course(self, course_title: str, skipped_lecture_ids: set[str] | None = None) -> None:
+        """
+        Switch to another course, keeping the browsers, so that several courses can be scraped with one scraper.
+        """
+        self.course_title = course_title
+        self.skipped_lecture_ids = skipped_lecture_ids or set()
         self.lectures: list[Echo360Lecture] = []
-        self.__driver: WebDriver | None = None
         self.course_url = self.config.course_urls[self.course_title]
         self.searched_files = self.config.searched_files[self.course_title]
 
     @property
-    def driver(self) -> WebDriver:
-        if self.__driver is None:
+    def driver(self) -> Driver:
+        if not self.__in_context:
             raise RuntimeError(f"{self.__class__.__name__} must be used within a context manager to use the driver.")
+        if self.__driver is None:
+            # The browser is only started once a page has to be opened, runs served from the cache don't need it
+            self.__setup_driver()
         return self.__driver
 
     def scrape_all_lectures(self) -> None:
         logger.info('Collecting lecture URLs...')
-        self.get_all_lecture_urls()
+        if not self.restore_cached_lectures():
+            self.get_all_lecture_urls()
+            self.cache_lectures()
         self.assign_numbers()
 
         logger.info('Collecting lecture file URLs...')
-        for lecture in self.lectures[self.lecture_indices]:
-            logger.info(f'Collecting file URLs for {lecture.title}')
-            lecture.file_infos = self.get_lecture_files(lecture.url)
+        lectures = self.restore_cached_file_infos(self.get_wanted_lectures())
+        pool_size = min(self.config.scraper.browser_pool_size, len(lectures))
+
+        if pool_size > 1:
+            self.get_lecture_files_in_parallel(lectures, pool_size)
+        else:
+            for lecture in lectures:
+                logger.info(f'Collecting file URLs for {lecture.title}')
+                lecture.file_infos = self.get_lecture_files(lecture.url)
+
+        self.cache_file_infos(lectures)
+
+    def get_wanted_lectures(self) -> list[Echo360Lecture]:
+        """
+        Return the lectures of the slice that aren't skipped and fall between ``since`` and ``until``.
+        """
+        return [lecture for lecture in self.lectures[self.lecture_indices]
+                if lecture.lecture_id not in self.skipped_lecture_ids
+                and (self.since is None or lecture.date >= self.since)
+                and (self.until is None or lecture.date <= self.until)]
+
+    def restore_cached_lectures(self) -> bool:
+        cached_lectures = (self.cache.load_lectures(self.course_url, self.get_row_limit())
+                           if self.cache is not None else None)
+        if cached_lectures is None:
+            return False
+
+        self.lectures = cached_lectures
+        return True
+
+    def cache_lectures(self) -> None:
+        if self.cache is not None:
+            self.cache.store_lectures(self.course_url, self.lectures, self.get_row_limit())
+
+    def restore_cached_file_infos(self, lectures: list[Echo360Lecture]) -> list[Echo360Lecture]:
+        """
+        Fill in the cached file URLs of the lectures, returning the lectures whose files still have to be collected.
+        Cached files that don't make up any file pair, e.g. of an earlier version or other ``file_pairs``, are dropped.
+        """
+        if self.cache is None:
+            return lectures
+
+        uncached_lectures = []
+        for lecture in lectures:
+            file_infos = self.cache.load_file_infos(self.course_url, lecture.lecture_id)
+            if file_infos is not None and not self.has_file_pair(file_infos):
+                logger.debug(f'Dropping the cached file URLs of {lecture.url}, they make up no file pair')
+                self.cache.drop_file_infos(self.course_url, lecture.lecture_id)
+                file_infos = None
+            if file_infos is None:
+                uncached_lectures.append(lecture)
+            else:
+                lecture.file_infos = file_infos
+
+        if len(uncached_lectures) < len(lectures):
+            logger.info(f'Using cached file URLs for {len(lectures) - len(uncached_lectures)} lecture(s)')
+        return uncached_lectures
+
+    def cache_file_infos(self, lectures: list[Echo360Lecture]) -> None:
+        """
+        Cache the file URLs of the lectures whose capture makes up at least one file pair. The others, e.g. of a
+        lecture whose capture timed out after the audio, are collected again by the next run.
+        """
+        complete_lectures = [lecture for lecture in lectures if self.has_file_pair(lecture.file_infos)]
+        if self.cache is not None and complete_lectures:
+            self.cache.store_file_infos(self.course_url, complete_lectures)
+
+    def has_file_pair(self, file_infos: list[FileInfo]) -> bool:
+        return bool(select_file_pairs(self.config, {info.file_name for info in file_infos}))
+
+    def get_lecture_files_in_parallel(self, lectures: list[Echo360Lecture], pool_size: int) -> None:
+        """
+        Spread the lectures over a pool of browsers, the scraper's own browser being one of them.
+        Every browser has its own performance log, so the captured responses of different lectures can't get mixed up.
+        The extra browsers start up while the first lectures are already being visited, and are kept for the next
+        courses until the scraper is closed.
+        """
+        idle_drivers: queue.Queue[Driver] = queue.Queue()
+        for driver in (self.driver, *self.__pool_drivers[:pool_size - 1]):
+            idle_drivers.put(driver)
+
+        def start_driver() -> None:
+            try:
+                driver = self.__create_driver()
+            except WebDriverException as e:
+                logger.warning(f'Failed to start an additional browser: {e.msg}')
+                return
+            self.__pool_drivers.append(driver)
+            idle_drivers.put(driver)
+
+        def get_files(lecture: Echo360Lecture) -> list[FileInfo]:
+            driver = idle_drivers.get()
+            try:
+                logger.info(f'Collecting file URLs for {lecture.title}')
+                return self.get_lecture_files(lecture.url, driver=driver)
+            finally:
+                idle_drivers.put(driver)
+
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for _ in range(pool_size - 1 - len(self.__pool_drivers)):
+                executor.submit(start_driver)
+            futures = [executor.submit(get_files, lecture) for lecture in lectures]
+
+        for lecture, future in zip(lectures, futures):
+            lecture.file_infos = future.result()
 
     def assign_numbers(self) -> None:
         earliest_date = min(lecture.date for lecture in self.lectures)
@@ -84,58 +258,147 @@ class EchoScraper:
                         lecture.lecture_in_week = i
 
     def get_all_lecture_urls(self) -> None:
+        """
+        Read all lecture rows of the course page with a single script, instead of three WebDriver calls per row.
+        With ``scraper.stop_after_range``, rows after the stop of the lecture slice aren't read at all. The page lists
+        the lectures from the oldest, so the numbers of the remaining lectures don't change.
+        """
+        # Opens the course page
         course_name = self.get_course_name()
-        self.driver.get(self.course_url)
         elements_of_lectures: list[WebElement] = (WebDriverWait(self.driver, 10)
         .until(
             ec.presence_of_all_elements_located(self.config.locators.lectures)))
 
-        for element in elements_of_lectures:
+        rows: list[dict[str, str]] = self.driver.execute_script(
+            READ_LECTURE_ROWS_SCRIPT, elements_of_lectures, self.config.locators.lecture_date,
+            self.config.locators.lecture_time, self.config.attributes.lecture_id_attribute, self.get_row_limit())
+
+        for row in rows:
             lecture = Echo360Lecture()
             lecture.course_name = course_name
 
-            date_string = element.find_element(*self.config.locators.lecture_date).text
-            start_time_string, end_time_string = element.find_element(*self.config.locators.lecture_time).text.split(
-                '-')
+            date_string = row['date']
+            start_time_string, end_time_string = row['time'].split('-')
 
             lecture.date = dt.strptime(date_string, self.config.formats.date_format)
             lecture.start_time = dt.strptime(start_time_string, self.config.formats.time_format)
             lecture.end_time = dt.strptime(end_time_string, self.config.formats.time_format)
 
-            lecture_id = element.get_attribute(self.config.attributes.lecture_id_attribute)
-            lecture.url = self.config.formats.lecture_url.format(lecture_id=lecture_id)
+            lecture.lecture_id = row['lecture_id']
+            lecture.url = self.config.formats.lecture_url.format(lecture_id=lecture.lecture_id)
 
             self.lectures.append(lecture)
 
-    def get_lecture_files(self, lecture_url: str, timeout_seconds: int = 4) -> list[FileInfo]:
-        self.driver.get(lecture_url)
-        self.driver.get_log('performance')
-        lecture_file_infos: dict[str, FileInfo] = {}
+    def get_lecture_files(self, lecture_url: str, timeout_seconds: int = 4, *,
+                          driver: Driver | None = None) -> list[FileInfo]:
+        """
+        Open the lecture and collect the URLs of the searched files from the network requests of its player.
+        The low footprint profile blocks every searched file once its URL has been captured, so the player can still
+        request each of its streams, but doesn't keep streaming them.
+        Once the player's stream manifests have been read, only the searched files that the lecture offers are waited
+        for, so a lecture without one of the streams (e.g. no camera) doesn't have to wait for the timeout.
+        Playlists of a single stream (e.g. "s0q1.m3u8") don't tell what else there is, so they aren't read.
+        """
+        driver = driver or self.driver
+        # Drop the responses of the previous lecture, before this one starts loading
+        self.get_network_messages(driver)
         start_time = time.time()
+        driver.get(lecture_url)
+        deadline = time.time() + timeout_seconds
 
-        while True:
-            if time.time() - start_time > timeout_seconds:
-                break
-
-            for entry in self.driver.get_log('performance'):
-                message = self.get_message_attribute(entry)
-
-                if message['method'] != 'Network.responseReceived':
+        lecture_file_infos: dict[str, FileInfo] = {}
+        offered_streams: set[str] = set()
+        unread_manifests: dict[str, str] = {}  # {request id: url}
+        last_manifest_time = start_time
+        expected_files = set(self.searched_files)
+
+        while time.time() <= deadline:
+            captured_count = len(lecture_file_infos)
+            for message in self.get_network_messages(driver):
+                is_response = message['method'] == 'Network.responseReceived'
+                url = message['params']['response' if is_response else 'request']['url']
+                file_name = os.path.basename(urlparse(url).path)
+
+                if file_name in self.searched_files:
+                    lecture_file_infos.setdefault(file_name, FileInfo(file_name, url))
+                elif (is_response and file_name.endswith(MANIFEST_EXTENSIONS)
+                      and not STREAM_NAME_PATTERN.fullmatch(file_name)):
+                    unread_manifests[message['params']['requestId']] = url
+                    last_manifest_time = time.time()
+
+            if len(lecture_file_infos) > captured_count and self.config.scraper.low_footprint_browser:
+                self.__block_urls(driver, (info.url for info in lecture_file_infos.values()))
+
+            for request_id, manifest_url in list(unread_manifests.items()):
+                body = self.get_response_body(driver, request_id)
+                if body is None:
+                    # The body is only available once the response has finished loading
                     continue
+                del unread_manifests[request_id]
+                offered_streams |= set(STREAM_NAME_PATTERN.findall(body))
+                logger.debug(f'Streams offered by {manifest_url}: {", ".join(sorted(offered_streams))}')
+
+            if offered_streams:
+                expected_files = {file_name for file_name in self.searched_files
+                                  if os.path.splitext(file_name)[0] in offered_streams}
 
-                response_url = message['params']['response']['url']
-                response_file_name = os.path.basename(urlparse(response_url).path)
+            found_all = lecture_file_infos.keys() >= set(self.searched_files)
+            manifests_settled = not unread_manifests and time.time() - last_manifest_time >= MANIFEST_SETTLE_TIME
+            if found_all or (manifests_settled and expected_files <= lecture_file_infos.keys()):
+                break
+            time.sleep(POLL_INTERVAL)
+        else:
+            missing_files = expected_files - lecture_file_infos.keys()
+            logger.debug(f'Timed out waiting for {", ".join(sorted(missing_files))} of {lecture_url}')
 
-                if response_file_name in self.searched_files:
-                    lecture_file_infos.setdefault(response_file_name, FileInfo(response_file_name, response_url))
+        logger.info(f'Found {len(lecture_file_infos)} file(s) of {lecture_url} in {time.time() - start_time:.2f}s')
+        return list(lecture_file_infos.values())
 
-                if len(lecture_file_infos) == len(self.searched_files):
-                    break
-            else:
+    def get_network_messages(self, driver: Driver) -> list[dict[str, Any]]:
+        """
+        Return the ``Network.requestWillBeSent`` and ``Network.responseReceived`` events logged since the last call,
+        that could be of interest.
+        The DevTools driver only records these events, and they arrive decoded already. Selenium's log entries are
+        filtered as strings first, so that only a few of them have to be decoded.
+        """
+        if isinstance(driver, CdpDriver):
+            return driver.get_events()
+
+        wanted_names = (*self.searched_files, *MANIFEST_EXTENSIONS)
+        messages = []
+
+        for entry in driver.get_log('performance'):
+            raw_message: str = entry['message']
+            if not any(f'"{method}"' in raw_message for method in NETWORK_METHODS):
+                continue
+            if not any(name in raw_message for name in wanted_names):
                 continue
-            break
 
-        return list(lecture_file_infos.values())
+            message = self.get_message_attribute(entry)
+            if message['method'] in NETWORK_METHODS:
+                messages.append(message)
+
+        return messages
+
+    @staticmethod
+    def get_response_body(driver: Driver, request_id: str) -> str | None:
+        try:
+            response = driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+        except WebDriverException:
+            return None
+
+        if response.get('base64Encoded'):
+            return base64.b64decode(response['body']).decode(errors='replace')
+        return response['body']
+
+    def get_row_limit(self) -> int | None:
+        """
+        Return the number of lecture rows needed for the lecture slice, if only those are read.
+        """
+        stop, step = self.lecture_indices.stop, self.lecture_indices.step
+        if not self.config.scraper.stop_after_range or stop is None or stop < 0 or (step is not None and step < 0):
+            return None
+        return stop
 
     def get_course_name(self) -> str:
         self.driver.get(self.course_url)
@@ -147,15 +410,20 @@ class EchoScraper:
         return course_name
 
     def __enter__(self) -> Self:
-        self.__setup_driver()
+        self.__in_context = True
         return self
 
     def __exit__(self,
                  exc_type: type[BaseException] | None,
                  exc_val: BaseException | None,
                  exc_tb: TracebackType | None) -> None:
-        self.driver.quit()
-        self.__driver = None
+        for driver in self.__pool_drivers:
+            self.__quit_driver(driver)
+        self.__pool_drivers.clear()
+        if self.__driver is not None:
+            self.__quit_driver(self.__driver)
+            self.__driver = None
+        self.__in_context = False
 
     @staticmethod
     def get_message_attribute(entry: dict[str, Any]) -> dict[str, Any]:
@@ -163,11 +431,118 @@ class EchoScraper:
         return response
 
     def __setup_driver(self) -> None:
-        options = Options()
-        if self.headless:
-            options.add_argument('--headless')
+        debugger_address = self.config.scraper.debugger_address
+        if debugger_address:
+            try:
+                self.__driver = self.__attach_driver(debugger_address)
+                return
+            except WebDriverException as e:
+                logger.warning(f'Failed to attach to the browser at {debugger_address} ({e.msg}), starting a new one')
+
+        self.__driver = self.__create_driver()
 
+    def __create_options(self) -> Options:
+        options = Options()
         options.add_argument('--log-level=3')
         options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        # Only network events are needed, page and timeline events would just grow the log
+        options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
+        return options
+
+    def __attach_driver(self, debugger_address: str) -> Driver:
+        """
+        Attach to an already running browser (e.g. one kept alive by ``echo-downloader-browser``), reusing its warm
+        process and cookies. The browser is left running when the scraper is done.
+        """
+        if self.config.scraper.backend == 'cdp':
+            # Works in a tab of its own, which its quit closes
+            driver = CdpDriver.attach(debugger_address, recorded_events=NETWORK_METHODS)
+        else:
+            options = self.__create_options()
+            options.debugger_address = debugger_address
+            driver = WebDriver(options=options)
+            self.__attached_drivers.add(id(driver))
+
+        if self.config.scraper.low_footprint_browser:
+            self.__block_urls(driver)
+        logger.debug(f'Attached to the browser at {debugger_address}')
+        return driver
+
+    def __create_driver(self) -> Driver:
+        if self.config.scraper.backend == 'cdp':
+            return self.__launch_cdp_driver()
+
+        options = self.__create_options()
+        if self.headless:
+            options.add_argument('--headless')
 
-        self.__driver = WebDriver(options=options)
+        if not self.config.scraper.low_footprint_browser:
+            return WebDriver(options=options)
+
+        for argument in LOW_FOOTPRINT_ARGUMENTS:
+            options.add_argument(argument)
+
+        profile_dir = create_profile_dir(in_memory=True)
+        options.add_argument(f'--user-data-dir={profile_dir}')
+
+        try:
+            driver = WebDriver(options=options)
+        except BaseException:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            raise
+
+        self.__profile_dirs[id(driver)] = profile_dir
+        self.__block_urls(driver)
+        return driver
+
+    def __launch_cdp_driver(self) -> CdpDriver:
+        """
+        Start a browser that is controlled over the DevTools protocol directly, without chromedriver.
+        """
+        low_footprint = self.config.scraper.low_footprint_browser
+        arguments = ['--headless'] if self.headless else []
+        if low_footprint:
+            arguments.extend(LOW_FOOTPRINT_ARGUMENTS)
+
+        # Chrome only opens its debugging port with a profile directory of its own
+        profile_dir = create_profile_dir(in_memory=low_footprint)
+        try:
+            driver = CdpDriver.launch(arguments, profile_dir, recorded_events=NETWORK_METHODS)
+        except BaseException:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            raise
+
+        self.__profile_dirs[id(driver)] = profile_dir
+        if low_footprint:
+            self.__block_urls(driver)
+        return driver
+
+    def __block_urls(self, driver: Driver, captured_urls: Iterable[str] = ()) -> None:
+        """
+        Block the configured URLs, and the captured file URLs of the current lecture instead of the earlier ones.
+        Media files are only blocked once captured, as a player whose first stream fails may not request the others.
+        """
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': [*self.config.scraper.blocked_urls, *captured_urls]})
+
+    def __quit_driver(self, driver: Driver) -> None:
+        if id(driver) in self.__attached_drivers:
+            self.__attached_drivers.discard(id(driver))
+            # Only stop chromedriver, the browser stays warm for the next run. Leaving the player page stops it
+            # from streaming in the meantime.
+            try:
+                driver.get('about:blank')
+            finally:
+                driver.service.stop()
+            return
+
+        driver.quit()
+        profile_dir = self.__profile_dirs.pop(id(driver), None)
+        if profile_dir is not None:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+
+
+def create_profile_dir(*, in_memory: bool) -> str:
+    # Keep the profile in memory where possible
+    in_memory_dir = '/dev/shm' if in_memory and os.path.isdir('/dev/shm') else None
+    return tempfile.mkdtemp(prefix='echo-downloader-', dir=in_memory_dir)
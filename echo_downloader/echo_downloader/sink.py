@@ -0,0 +1,191 @@
+import asyncio
+import concurrent.futures
+import errno
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import TracebackType
+from typing import Self
+
+from .config_wrapper import EchoDownloaderConfig
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+class InlineHasher:
+    """
+    Hashes a file in order while it is being written.
+    Data written at the offset hashed so far is hashed right away. Data written further on (the later ranges of a
+    segmented download, bytes written by an earlier run) is read back from the file as soon as everything before it
+    has been hashed, while it is likely still in the page cache, so that the hash keeps up with the download range by
+    range. ``finish`` only reads what is left, e.g. after writes that weren't reported.
+    """
+
+    def __init__(self, algorithm: str, path: str):
+        self.hash = hashlib.new(algorithm)
+        self.path = path
+        self.offset = 0
+        self.__written: dict[int, int] = {}  # {start: end} of the data written past the hashed offset
+        self.__lock = threading.Lock()
+
+    def update(self, offset: int, data: bytes | bytearray) -> None:
+        """
+        Report data that has been written to the file at the offset.
+        """
+        with self.__lock:
+            self.__catch_up()
+            if offset == self.offset:
+                self.hash.update(data)
+                self.offset += len(data)
+            elif offset > self.offset:
+                self.__written[offset] = offset + len(data)
+            self.__catch_up()
+
+    def mark_written(self, offset: int, size: int) -> None:
+        """
+        Report data that is in the file already, it is read back by the next ``update``.
+        """
+        with self.__lock:
+            if size > 0 and offset >= self.offset:
+                self.__written[offset] = offset + size
+
+    def finish(self) -> str:
+        with self.__lock, open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while chunk := f.read(HASH_READ_SIZE):
+                self.hash.update(chunk)
+                self.offset += len(chunk)
+            return self.hash.hexdigest()
+
+    def __catch_up(self) -> None:
+        if self.offset not in self.__written:
+            return
+
+        with open(self.path, 'rb') as f:
+            while self.offset in self.__written:
+                end = self.__written.pop(self.offset)
+                f.seek(self.offset)
+                while self.offset < end and (chunk := f.read(min(HASH_READ_SIZE, end - self.offset))):
+                    self.hash.update(chunk)
+                    self.offset += len(chunk)
+                if self.offset < end:
+                    # The file is shorter than reported, ``finish`` reads whatever is there
+                    break
+
+
+class FileSink:
+    """
+    Writes a stream of chunks into a file, starting at an offset.
+    Chunks are coalesced into a buffer that is flushed at multiples of ``buffer_size`` from the start of the file,
+    and every flush is written by a writer thread while the next buffer fills up.
+    ``written_bytes`` only counts bytes that have reached the file.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor, path: str, offset: int, buffer_size: int,
+                 hasher: InlineHasher | None = None):
+        self.executor = executor
+        self.fd = os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        self.buffer = bytearray()
+        self.buffer_offset = offset
+        self.buffer_size = max(buffer_size, 1)
+        self.hasher = hasher
+        self.written_bytes = 0
+        self.__pending: concurrent.futures.Future[int] | None = None
+
+    async def write(self, chunk: bytes) -> None:
+        self.buffer += chunk
+        while len(self.buffer) >= (aligned_size := self.buffer_size - self.buffer_offset % self.buffer_size):
+            await self.__submit(aligned_size)
+
+    async def flush(self) -> None:
+        if self.buffer:
+            await self.__submit(len(self.buffer))
+        await self.__wait()
+
+    def close(self) -> None:
+        # A write that is already running in a thread can't be interrupted, the file is closed once it is done
+        if self.__pending is None:
+            os.close(self.fd)
+        else:
+            self.__pending.add_done_callback(lambda _: os.close(self.fd))
+            self.__pending = None
+
+    async def __submit(self, size: int) -> None:
+        await self.__wait()
+        data = self.buffer[:size]
+        del self.buffer[:size]
+        self.__pending = self.executor.submit(write_at, self.fd, data, self.buffer_offset, self.hasher)
+        self.buffer_offset += size
+
+    async def __wait(self) -> None:
+        if self.__pending is not None:
+            self.written_bytes += await asyncio.wrap_future(self.__pending)
+            self.__pending = None
+
+
+class WriterPool:
+    """
+    A small pool of threads that all downloads of a run write their files with.
+    """
+
+    def __init__(self, options: EchoDownloaderConfig.Downloader):
+        self.options = options
+        self.__executor = ThreadPoolExecutor(max_workers=max(options.writer_threads, 1),
+                                             thread_name_prefix='download-writer')
+
+    def open(self, path: str, offset: int, hasher: InlineHasher | None = None) -> FileSink:
+        return FileSink(self.__executor, path, offset, self.options.write_buffer_size, hasher)
+
+    def create_hasher(self, path: str) -> InlineHasher | None:
+        return InlineHasher(self.options.checksum, path) if self.options.checksum != 'none' else None
+
+    async def finish_hash(self, hasher: InlineHasher) -> str:
+        return await asyncio.wrap_future(self.__executor.submit(hasher.finish))
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self,
+                        exc_type: type[BaseException] | None,
+                        exc_val: BaseException | None,
+                        exc_tb: TracebackType | None) -> None:
+        await asyncio.to_thread(self.__executor.shutdown)
+
+
+def write_at(fd: int, data: bytearray, offset: int, hasher: InlineHasher | None) -> int:
+    view = memoryview(data)
+    position = offset
+
+    while view:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, view, position)
+        else:
+            # Every sink has its own descriptor and one write at a time, so seeking is safe
+            os.lseek(fd, position, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        position += written
+
+    if hasher is not None:
+        hasher.update(offset, data)
+    return len(data)
+
+
+def create_file(path: str, size: int) -> None:
+    """
+    Create an empty file, reserving ``size`` bytes of disk space for it, so that its blocks end up contiguous
+    and running out of space is noticed before anything is downloaded.
+    """
+    with open(path, 'wb') as f:
+        if size <= 0:
+            return
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except AttributeError:
+            f.truncate(size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            # The file system doesn't support allocating space up front
+            f.truncate(size)
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import subprocess
+
+import aiohttp
+
+from .config_wrapper import EchoDownloaderConfig
+from .domain import Echo360Lecture
+from .downloader import create_session, warm_up_session
+from .manifest import DownloadManifest
+from .merger import get_pending_file_infos, get_temp_path, is_valid_output, record_merge, remove_file
+from .planner import plan_lecture_files
+from .retry import DownloadFailure, Retrier
+from .scheduler import rank_lectures
+from .throttle import Throttle
+
+logger = logging.getLogger(__name__)
+
+
+async def stream_and_merge(config: EchoDownloaderConfig, output_dir: str, lectures: list[Echo360Lecture],
+                           manifest: DownloadManifest | None = None) -> list[DownloadFailure]:
+    """
+    Merge the lectures without writing their audio and video files to disk.
+    The response bodies are piped straight into ffmpeg, which writes every output file of a lecture in a single pass.
+    Returns the lectures whose streams or merges failed for good.
+    """
+    logger.info('Streaming files into ffmpeg...')
+    options = config.downloader
+    retrier = Retrier(options)
+
+    async with create_session(options) as session, Throttle(options) as throttle:
+        await warm_up_session(session)
+        await plan_lecture_files(config, session, lectures, output_dir, manifest)
+
+        lecture_ranks = rank_lectures(lectures, options.order)
+        merges_by_lecture: dict[int, list[dict[str, str]]] = {}
+
+        for lecture, info in get_pending_file_infos(config, output_dir, lectures, manifest):
+            merges_by_lecture.setdefault(id(lecture), []).append(info)
+
+        ordered_lectures = sorted((lecture for lecture in lectures if id(lecture) in merges_by_lecture),
+                                  key=lambda lecture: lecture_ranks[id(lecture)])
+        semaphore = asyncio.Semaphore(max(options.max_concurrent_files, 1))
+
+        async def process_lecture(lecture: Echo360Lecture) -> None:
+            async with semaphore:
+                file_infos = merges_by_lecture[id(lecture)]
+                # A broken stream can't be resumed midway, so the whole lecture is streamed again
+                error = await retrier.run(lambda: stream_lecture(session, throttle, lecture, file_infos), lecture.title)
+                if error:
+                    retrier.failures.append(DownloadFailure(f'merging {lecture.title}', error))
+                elif error is not None and manifest is not None:
+                    for info in file_infos:
+                        record_merge(manifest, lecture, info)
+
+        await asyncio.gather(*(process_lecture(lecture) for lecture in ordered_lectures))
+
+    retrier.log_summary()
+    logger.info('All files merged')
+    return retrier.failures
+
+
+async def stream_lecture(session: aiohttp.ClientSession, throttle: Throttle, lecture: Echo360Lecture,
+                         file_infos: list[dict[str, str]]) -> str:
+    """
+    Produce all output files of the lecture with one ffmpeg process, every needed file being downloaded exactly once.
+    The outputs are written to temporary files, which replace the outputs once all of them have been verified.
+    Download errors are raised after cleaning up, so that the caller can retry. Other errors are returned,
+    an empty string means that the lecture was merged.
+    """
+    urls = {info.file_name: info.url for info in lecture.file_infos}
+    file_names = list(dict.fromkeys(os.path.basename(info[key]) for info in file_infos
+                                    for key in ('audio_path', 'video_path')))
+    pipes = {file_name: os.pipe() for file_name in file_names}
+
+    ffmpeg_cmd = ['ffmpeg', '-y']
+    for file_name in file_names:
+        ffmpeg_cmd += ['-i', f'pipe:{pipes[file_name][0]}']
+    for info in file_infos:
+        audio_index = file_names.index(os.path.basename(info['audio_path']))
+        video_index = file_names.index(os.path.basename(info['video_path']))
+        os.makedirs(os.path.dirname(info['output_path']), exist_ok=True)
+        ffmpeg_cmd += ['-map', f'{audio_index}:a', '-map', f'{video_index}:v', '-c:a', 'copy', '-c:v', 'copy',
+                       '-f', 'mp4', get_temp_path(info['output_path'])]
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *ffmpeg_cmd, pass_fds=[read_fd for read_fd, _ in pipes.values()],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        logger.error(f'Failed to start ffmpeg for {lecture.title}: {e!r}')
+        for _, write_fd in pipes.values():
+            os.close(write_fd)
+        return f'failed to start ffmpeg: {e!r}'
+    finally:
+        # The read ends belong to ffmpeg now
+        for read_fd, _ in pipes.values():
+            os.close(read_fd)
+
+    stream_error: BaseException | None = None
+    error = ''
+    # ffmpeg needs all pipes of the lecture fed at the same time, so they share a single slot. With a slot for every
+    # pipe, the lectures in progress could hold all slots with some of their pipes, and none of them would finish
+    async with throttle.stream():
+        tasks = [asyncio.create_task(feed_pipe(session, throttle, urls[file_name], write_fd))
+                 for file_name, (_, write_fd) in pipes.items()]
+        try:
+            await asyncio.gather(*tasks)
+            return_code = await process.wait()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            throttle.failed()
+            stream_error = e
+            return_code = None
+        except OSError as e:
+            error = f'failed to stream: {e!r}'
+            return_code = None
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    temp_paths = [get_temp_path(info['output_path']) for info in file_infos]
+    if return_code == 0 and not all(await asyncio.gather(*(asyncio.to_thread(is_valid_output, path)
+                                                            for path in temp_paths))):
+        error = 'the merged files are not valid'
+        return_code = None
+    elif return_code:
+        error = f'ffmpeg exited with {return_code}'
+
+    if return_code != 0:
+        for temp_path in temp_paths:
+            remove_file(temp_path)
+        if stream_error is not None:
+            raise stream_error
+        logger.error(f'Error while merging {lecture.title}, {error}')
+        return error
+
+    for info, temp_path in zip(file_infos, temp_paths):
+        os.replace(temp_path, info['output_path'])
+    for info in file_infos:
+        logger.info(f'Merging completed successfully! ({info["audio_path"]} + {info["video_path"]} => {info["output_path"]})')
+    return ''
+
+
+async def feed_pipe(session: aiohttp.ClientSession, throttle: Throttle, url: str, write_fd: int) -> None:
+    """
+    Stream the response body into the write end of a pipe, closing it afterwards so that ffmpeg sees the end of input.
+    The caller holds the concurrency slot of the stream.
+    """
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, os.fdopen(write_fd, 'wb'))
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    file_bucket = throttle.file_bucket()
+
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_any():
+                writer.write(chunk)
+                await writer.drain()
+                await throttle.transferred(file_bucket, len(chunk))
+    finally:
+        writer.close()
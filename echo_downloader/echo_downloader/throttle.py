@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from types import TracebackType
+from typing import Self
+
+from .config_wrapper import EchoDownloaderConfig
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Limits the rate of transferred bytes. A rate of 0 means no limit.
+    Consuming more tokens than are available puts the bucket into debt, which the caller waits out.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+
+    async def consume(self, amount: int) -> None:
+        if self.rate <= 0:
+            return
+
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate) - amount
+        self.last_refill = now
+
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+class AimdController:
+    """
+    Adjusts the number of concurrent streams with additive increase and multiplicative decrease.
+    Every interval, the limit is halved if any stream failed, raised by one if the previous raise improved the
+    aggregate throughput, and lowered by one if the throughput dropped. Without failures, the limit is only changed
+    while all slots are in use, so running out of work isn't mistaken for throttling.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, interval: float, gain_threshold: float = 0.05):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.interval = interval
+        self.gain_threshold = gain_threshold
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.transferred_bytes = 0
+        self.failures = 0
+        self.previous_throughput = 0.0
+        self.__condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            async with self.__condition:
+                self.in_flight -= 1
+                self.__condition.notify_all()
+
+    def record_bytes(self, amount: int) -> None:
+        self.transferred_bytes += amount
+
+    def record_failure(self) -> None:
+        self.failures += 1
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.adjust()
+
+    async def adjust(self) -> None:
+        throughput = self.transferred_bytes / self.interval
+        saturated = self.peak_in_flight >= self.limit
+        old_limit = self.limit
+
+        if self.failures:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif saturated and throughput < self.previous_throughput * (1 - self.gain_threshold):
+            self.limit = max(self.minimum, self.limit - 1)
+        elif saturated and throughput >= self.previous_throughput * (1 + self.gain_threshold):
+            self.limit = min(self.maximum, self.limit + 1)
+
+        if self.limit != old_limit:
+            logger.debug(f'Concurrent streams {old_limit} -> {self.limit} '
+                         f'({throughput / 2 ** 20:.1f} MiB/s, {self.failures} failures)')
+
+        self.previous_throughput = throughput
+        self.transferred_bytes = 0
+        self.failures = 0
+        self.peak_in_flight = self.in_flight
+
+        async with self.__condition:
+            self.__condition.notify_all()
+
+
+class Throttle:
+    """
+    Bandwidth and concurrency limits shared by all downloads of a run.
+    Every stream (a whole file or one of its ranges) runs in a slot and reports the bytes it transfers.
+    """
+
+    def __init__(self, options: EchoDownloaderConfig.Downloader):
+        self.options = options
+        self.bucket = TokenBucket(options.bandwidth_limit)
+        self.controller = AimdController(options.max_concurrent_files, options.min_streams, options.max_streams,
+                                         options.adjust_interval) if options.adaptive_concurrency else None
+        self.__controller_task: asyncio.Task[None] | None = None
+
+    def file_bucket(self) -> TokenBucket:
+        return TokenBucket(self.options.per_file_bandwidth_limit)
+
+    @asynccontextmanager
+    async def stream(self) -> AsyncIterator[None]:
+        if self.controller is None:
+            yield
+            return
+
+        async with self.controller.slot():
+            yield
+
+    async def transferred(self, file_bucket: TokenBucket, amount: int) -> None:
+        if self.controller is not None:
+            self.controller.record_bytes(amount)
+        await self.bucket.consume(amount)
+        await file_bucket.consume(amount)
+
+    def failed(self) -> None:
+        if self.controller is not None:
+            self.controller.record_failure()
+
+    async def __aenter__(self) -> Self:
+        if self.controller is not None:
+            self.__controller_task = asyncio.create_task(self.controller.run())
+        return self
+
+    async def __aexit__(self,
+                        exc_type: type[BaseException] | None,
+                        exc_val: BaseException | None,
+                        exc_tb: TracebackType | None) -> None:
+        if self.__controller_task is not None:
+            self.__controller_task.cancel()
+            await asyncio.gather(self.__controller_task, return_exceptions=True)
+            self.__controller_task = None
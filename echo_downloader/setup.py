@@ -10,6 +10,7 @@ setup(
     entry_points={
         'console_scripts': [
             'echo-downloader = echo_downloader.main:main',
+            'echo-downloader-browser = echo_downloader.browser:main',
         ],
     },
     package_data={
@@ -0,0 +1,18 @@
+import os
+
+import pytest
+import yaml
+from utils_anviks import dict_to_object
+
+from echo_downloader.config_wrapper import EchoDownloaderConfig
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.yaml')
+
+
+@pytest.fixture
+def config() -> EchoDownloaderConfig:
+    with open(CONFIG_PATH) as f:
+        config_dict = yaml.safe_load(f)
+    # The abbreviations come from the user's own config
+    config_dict.setdefault('course_abbreviations', {})
+    return dict_to_object(config_dict, EchoDownloaderConfig)
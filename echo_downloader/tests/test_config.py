@@ -0,0 +1,24 @@
+import shutil
+from pathlib import Path
+
+import yaml
+
+from echo_downloader.main import load_config
+
+CONFIG_PATH = str(Path(__file__).parent.parent / 'config.yaml')
+OLD_USER_CONFIG_PATH = Path(__file__).parent / 'fixtures' / 'config' / 'user_config.yaml'
+
+
+def test_config_of_an_old_install_loads(tmp_path: Path):
+    custom_config_path = tmp_path / 'config.yaml'
+    shutil.copy(OLD_USER_CONFIG_PATH, custom_config_path)
+
+    config = load_config(CONFIG_PATH, str(custom_config_path))
+
+    # The sections the user's config lacks come from the defaults
+    with open(CONFIG_PATH) as f:
+        defaults = yaml.safe_load(f)
+    assert config.scraper.syllabus_url == defaults['scraper']['syllabus_url']
+    assert config.downloader.segments == defaults['downloader']['segments']
+    assert config.course_abbreviations == {'tt': 'ICD0013 - Tarkvaratehnika'}
+
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import threading
+from collections.abc import Iterator
+from datetime import datetime
+
+import pytest
+from aiohttp import web
+
+from echo_downloader.config_wrapper import EchoDownloaderConfig
+from echo_downloader.http_scraper import EchoHttpScraper, ScrapingError
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'echo360')
+COURSE_TITLE = 'TEST0001 - Test course'
+SECTION_ID = '9d2c7e4a-3b1f-4c8d-a6e5-0f1e2d3c4b5a'
+LESSON_PAGES = {
+    'G_5f0c2b8e-1d4a-4f6e-9a3b-1c2d3e4f5a61_2024-02-05T10:00:00.000_2024-02-05T11:30:00.000': 'lesson_1.html',
+    'G_5f0c2b8e-1d4a-4f6e-9a3b-1c2d3e4f5a62_2024-02-14T12:00:00.000_2024-02-14T13:30:00.000': 'lesson_2.html',
+}
+CONTENT_HOST = 'https://content.echo360.org.uk'
+
+
+class Echo360StandIn:
+    """
+    Serves the recorded Echo360 pages on a local port, with the media host of the pages pointing to itself.
+    Syllabus requests for other sections get the login page, like requests without a valid session.
+    """
+
+    def __init__(self):
+        self.base_url = ''
+        self.requested_paths: list[str] = []
+        self.__loop = asyncio.new_event_loop()
+        self.__runner: web.AppRunner | None = None
+
+    def start(self) -> None:
+        threading.Thread(target=self.__loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.__start(), self.__loop).result()
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.__runner.cleanup(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+
+    async def __start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/section/{section_id}/public', self.__course)
+        app.router.add_get('/section/{section_id}/syllabus', self.__syllabus)
+        app.router.add_get('/lesson/{lesson_id}/classroom', self.__lesson)
+        app.router.add_get('/{path:.+\\.m3u8}', self.__manifest)
+        app.middlewares.append(self.__record)
+
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self.__runner.addresses[0][:2]
+        self.base_url = f'http://{host}:{port}'
+
+    @web.middleware
+    async def __record(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requested_paths.append(request.path)
+        return await handler(request)
+
+    async def __course(self, request: web.Request) -> web.Response:
+        return self.__serve('course.html')
+
+    async def __syllabus(self, request: web.Request) -> web.Response:
+        if request.match_info['section_id'] != SECTION_ID:
+            return self.__serve('login.html')
+        return self.__serve('syllabus.json')
+
+    async def __lesson(self, request: web.Request) -> web.Response:
+        file_name = LESSON_PAGES.get(request.match_info['lesson_id'])
+        if file_name is None:
+            raise web.HTTPNotFound()
+        return self.__serve(file_name)
+
+    async def __manifest(self, request: web.Request) -> web.Response:
+        return self.__serve('s1_av.m3u8')
+
+    def __serve(self, file_name: str) -> web.Response:
+        with open(os.path.join(FIXTURES_DIR, file_name), encoding='utf-8') as f:
+            body = f.read().replace(CONTENT_HOST, self.base_url).replace(CONTENT_HOST.replace('/', '\\/'),
+                                                                         self.base_url.replace('/', '\\/'))
+        content_type = 'application/json' if file_name.endswith('.json') else 'text/html'
+        return web.Response(text=body, content_type=content_type)
+
+
+@pytest.fixture
+def echo_server() -> Iterator[Echo360StandIn]:
+    server = Echo360StandIn()
+    server.start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def scraper_config(config: EchoDownloaderConfig, echo_server: Echo360StandIn) -> EchoDownloaderConfig:
+    config.scraper.base_url = echo_server.base_url
+    config.course_urls = {COURSE_TITLE: f'https://echo360.org.uk/section/{SECTION_ID}/public'}
+    config.searched_files = {COURSE_TITLE: ('s0q1.m4s', 's1q1.m4s', 's2q1.m4s')}
+    return config
+
+
+def scrape(config: EchoDownloaderConfig, lecture_indices: slice = slice(None)) -> EchoHttpScraper:
+    with EchoHttpScraper(config, COURSE_TITLE, lecture_indices) as scraper:
+        scraper.scrape_all_lectures()
+    return scraper
+
+
+def test_lectures_are_read_from_the_syllabus(scraper_config: EchoDownloaderConfig):
+    lectures = scrape(scraper_config).lectures
+
+    # Future lectures and lectures without a scheduled time are left out, like on the course page
+    assert [lecture.lecture_id for lecture in lectures] == list(LESSON_PAGES)
+    assert [lecture.title for lecture in lectures] == [
+        '[05.02.2024 - 10:00-11:30] TEST0001 - Test course #1.1',
+        '[14.02.2024 - 12:00-13:30] TEST0001 - Test course #2.1',
+    ]
+    assert lectures[0].date == datetime(2024, 2, 5)
+    assert lectures[0].url == ('https://echo360.org.uk/lesson/G_5f0c2b8e-1d4a-4f6e-9a3b-1c2d3e4f5a61_'
+                               '2024-02-05T10:00:00.000_2024-02-05T11:30:00.000/classroom')
+
+
+def test_file_urls_are_found_in_the_lecture_page(scraper_config: EchoDownloaderConfig, echo_server: Echo360StandIn):
+    lecture = scrape(scraper_config).lectures[0]
+
+    # s2q0.m4s isn't searched for
+    assert {info.file_name: info.url for info in lecture.file_infos} == {
+        file_name: f'{echo_server.base_url}/0000.5f0c2b8e/1/{file_name}'
+                   f'?Policy=eyJ0ZXN0IjoxfQ__&Signature=abc&Key-Pair-Id=APKTEST'
+        for file_name in ('s0q1.m4s', 's1q1.m4s', 's2q1.m4s')
+    }
+
+
+def test_file_urls_are_found_in_the_stream_manifest(scraper_config: EchoDownloaderConfig,
+                                                    echo_server: Echo360StandIn):
+    lecture = scrape(scraper_config).lectures[1]
+
+    # The files are next to the manifest and signed like it
+    assert {info.file_name: info.url for info in lecture.file_infos} == {
+        file_name: f'{echo_server.base_url}/0000.5f0c2b8e/2/{file_name}'
+                   f'?Policy=eyJ0ZXN0IjoyfQ__&Signature=def&Key-Pair-Id=APKTEST'
+        for file_name in ('s0q1.m4s', 's1q1.m4s')
+    }
+
+
+def test_only_the_lecture_pages_of_the_slice_are_read(scraper_config: EchoDownloaderConfig,
+                                                      echo_server: Echo360StandIn):
+    lectures = scrape(scraper_config, slice(1, None)).lectures
+
+    assert not lectures[0].file_infos
+    assert len(lectures[1].file_infos) == 2
+    assert [path for path in echo_server.requested_paths if path.startswith('/lesson/')] == [
+        '/lesson/G_5f0c2b8e-1d4a-4f6e-9a3b-1c2d3e4f5a62_2024-02-14T12:00:00.000_2024-02-14T13:30:00.000/classroom']
+
+
+def test_login_page_instead_of_the_syllabus_is_a_scraping_error(scraper_config: EchoDownloaderConfig):
+    # Raised as ScrapingError, so that the run falls back to the browser scraper
+    scraper_config.course_urls[COURSE_TITLE] = 'https://echo360.org.uk/section/expired-session/public'
+
+    with pytest.raises(ScrapingError):
+        scrape(scraper_config)
@@ -0,0 +1,120 @@
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from echo_downloader.remux import Box, RemuxError, find_box, iter_boxes, read_uint, remux
+
+FFMPEG = shutil.which('ffmpeg')
+FRAGMENTED_MP4 = ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof']
+
+pytestmark = pytest.mark.skipif(FFMPEG is None, reason='ffmpeg is not installed')
+
+
+def run_ffmpeg(*args: str | Path) -> str:
+    process = subprocess.run([FFMPEG, '-nostdin', '-v', 'error', '-y', *map(str, args)], capture_output=True, text=True)
+    if process.returncode != 0:
+        pytest.skip(f'ffmpeg failed: {process.stderr.strip()}')
+    return process.stdout
+
+
+@pytest.fixture(scope='module')
+def streams(tmp_path_factory: pytest.TempPathFactory) -> tuple[Path, Path]:
+    """
+    Fragmented AAC and H.264 streams like the ones Echo360 serves, the audio with another movie timescale.
+    The video has B-frames, so its presentation times are offset from its decode times.
+    """
+    directory = tmp_path_factory.mktemp('streams')
+    audio_path, video_path = directory / 's0q1.m4s', directory / 's1q1.m4s'
+    run_ffmpeg('-f', 'lavfi', '-i', 'sine=frequency=440:duration=12', '-c:a', 'aac', '-frag_duration', '2000000',
+               '-movie_timescale', '600', *FRAGMENTED_MP4, audio_path)
+    run_ffmpeg('-f', 'lavfi', '-i', 'testsrc=duration=12:size=320x240:rate=25', '-c:v', 'libx264', '-bf', '2',
+               '-g', '50', *FRAGMENTED_MP4, video_path)
+    return audio_path, video_path
+
+
+def read_packets(path: Path, stream: str, *extra_args: str) -> list[tuple[int, int, int, int, str]]:
+    """
+    Return the dts, pts, duration, size and hash of every packet of the stream.
+    """
+    lines = run_ffmpeg(*extra_args, '-i', path, '-map', stream, '-c', 'copy', '-f', 'framemd5', '-').splitlines()
+    return [(int(dts), int(pts), int(duration), int(size), md5.strip())
+            for _, dts, pts, duration, size, md5 in (line.split(',') for line in lines if not line.startswith('#'))]
+
+
+def from_first_pts(packets: list[tuple[int, int, int, int, str]]) -> list[tuple[int, int, int, int, str]]:
+    first_pts = packets[0][1]
+    return [(dts - first_pts, pts - first_pts, *rest) for dts, pts, *rest in packets]
+
+
+def get_top_level_box(data: bytes, box_type: bytes) -> Box:
+    return next(box for box in iter_boxes(data, 0, len(data)) if box.type == box_type)
+
+
+def get_traks(data: bytes) -> list[Box]:
+    moov = get_top_level_box(data, b'moov')
+    return [box for box in iter_boxes(data, moov.payload_start, moov.end) if box.type == b'trak']
+
+
+def shift_decode_times(source_path: Path, destination_path: Path, offset: int) -> None:
+    data = bytearray(source_path.read_bytes())
+    for moof in (box for box in iter_boxes(data, 0, len(data)) if box.type == b'moof'):
+        tfdt = find_box(data, find_box(data, moof, b'traf'), b'tfdt')
+        size = 8 if data[tfdt.payload_start] == 1 else 4
+        position = tfdt.payload_start + 4
+        data[position:position + size] = (read_uint(data, position, size) + offset).to_bytes(size, 'big')
+    destination_path.write_bytes(data)
+
+
+def test_packets_match_a_merge_with_ffmpeg(streams: tuple[Path, Path], tmp_path: Path):
+    audio_path, video_path = streams
+    remux(str(audio_path), str(video_path), str(tmp_path / 'native.mp4'))
+    run_ffmpeg('-i', audio_path, '-i', video_path, '-c:a', 'copy', '-c:v', 'copy', tmp_path / 'ffmpeg.mp4')
+
+    for stream, source_path in (('0:a', audio_path), ('0:v', video_path)):
+        # ffmpeg also shifts out the composition offset of the first video frame, so the timestamps are compared
+        # from the first presented packet
+        native_packets = from_first_pts(read_packets(tmp_path / 'native.mp4', stream))
+        assert native_packets == from_first_pts(read_packets(tmp_path / 'ffmpeg.mp4', stream))
+        assert native_packets == from_first_pts(read_packets(source_path, stream))
+
+
+def test_tracks_start_at_zero(streams: tuple[Path, Path], tmp_path: Path):
+    audio_path, video_path = streams
+    # Like a stream cut out of a longer recording
+    shifted_audio_path = tmp_path / 'shifted.m4s'
+    shift_decode_times(audio_path, shifted_audio_path, 1000 * 44100)
+    assert read_packets(shifted_audio_path, '0:a', '-copyts')[0][0] == 1000 * 44100
+
+    remux(str(shifted_audio_path), str(video_path), str(tmp_path / 'native.mp4'))
+
+    for stream in ('0:a', '0:v'):
+        assert read_packets(tmp_path / 'native.mp4', stream, '-copyts')[0][0] == 0
+
+
+def test_track_durations_are_in_the_movie_timescale(streams: tuple[Path, Path], tmp_path: Path):
+    audio_path, video_path = streams
+    remux(str(audio_path), str(video_path), str(tmp_path / 'native.mp4'))
+    data = (tmp_path / 'native.mp4').read_bytes()
+
+    mvhd = find_box(data, get_top_level_box(data, b'moov'), b'mvhd')
+    assert data[mvhd.payload_start] == 0
+    movie_timescale = read_uint(data, mvhd.payload_start + 12, 4)
+
+    for track_id, trak in enumerate(get_traks(data), 1):
+        assert find_box(data, trak, b'edts') is None
+        tkhd = find_box(data, trak, b'tkhd')
+        assert data[tkhd.payload_start] == 0
+        assert read_uint(data, tkhd.payload_start + 12, 4) == track_id
+        duration = read_uint(data, tkhd.payload_start + 20, 4)
+        assert duration / movie_timescale == pytest.approx(12, abs=0.1)
+
+
+def test_unfragmented_input_is_rejected(streams: tuple[Path, Path], tmp_path: Path):
+    audio_path, video_path = streams
+    run_ffmpeg('-i', audio_path, '-c', 'copy', '-f', 'mp4', tmp_path / 'audio.mp4')
+
+    # The merger falls back to ffmpeg on RemuxError
+    with pytest.raises(RemuxError):
+        remux(str(tmp_path / 'audio.mp4'), str(video_path), str(tmp_path / 'native.mp4'))
@@ -0,0 +1,42 @@
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from echo_downloader.config_wrapper import EchoDownloaderConfig
+from echo_downloader.domain import Echo360Lecture, FileInfo
+from echo_downloader.scrape_cache import ScrapeCache
+from echo_downloader.scraper import EchoScraper
+
+
+@pytest.fixture
+def scraper(config: EchoDownloaderConfig, tmp_path: Path) -> EchoScraper:
+    course_title = next(iter(config.course_urls))
+    # No browser is started, the file URLs only go through the cache
+    return EchoScraper(config, course_title, slice(None), cache=ScrapeCache(str(tmp_path), config.scraper))
+
+
+def create_lecture(lecture_id: str, *file_names: str) -> Echo360Lecture:
+    held_at = datetime(2024, 4, 10, 10)
+    return Echo360Lecture(held_at, held_at, held_at, 'Course', lecture_id, '', 1, 1,
+                          [FileInfo(file_name, f'https://example.com/{lecture_id}/{file_name}')
+                           for file_name in file_names])
+
+
+def test_only_captures_with_a_file_pair_are_cached(scraper: EchoScraper):
+    # The capture of the second lecture timed out after the audio
+    scraper.cache_file_infos([create_lecture('complete', 's0q1.m4s', 's1q1.m4s'),
+                              create_lecture('partial', 's0q1.m4s')])
+
+    lectures = [create_lecture('complete'), create_lecture('partial')]
+    assert scraper.restore_cached_file_infos(lectures) == [lectures[1]]
+    assert [info.file_name for info in lectures[0].file_infos] == ['s0q1.m4s', 's1q1.m4s']
+
+
+def test_cached_files_without_a_file_pair_are_dropped(scraper: EchoScraper):
+    # Like the partial captures that earlier versions cached
+    scraper.cache.store_file_infos(scraper.course_url, [create_lecture('partial', 's0q1.m4s')])
+
+    lecture = create_lecture('partial')
+    assert scraper.restore_cached_file_infos([lecture]) == [lecture]
+    assert scraper.cache.load_file_infos(scraper.course_url, 'partial') is None
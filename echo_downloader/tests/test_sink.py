@@ -0,0 +1,54 @@
+import hashlib
+import os
+import random
+from pathlib import Path
+
+from echo_downloader.sink import InlineHasher, create_file, write_at
+
+SIZE = 3 * 1024 * 1024 + 17
+CHUNK_SIZE = 64 * 1024
+
+
+def write_ranges(path: Path, data: bytes, ranges: list[tuple[int, int]], hasher: InlineHasher) -> None:
+    """
+    Write the ranges chunk by chunk, interleaved like the parallel range requests of a segmented download.
+    """
+    chunks = [[(offset, data[offset:min(offset + CHUNK_SIZE, end)]) for offset in range(start, end, CHUNK_SIZE)]
+              for start, end in ranges]
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        while any(chunks):
+            offset, chunk = random.choice([chunk for chunk in chunks if chunk]).pop(0)
+            write_at(fd, bytearray(chunk), offset, hasher)
+    finally:
+        os.close(fd)
+
+
+def test_segments_are_hashed_while_they_are_written(tmp_path: Path):
+    path = tmp_path / 'file.part'
+    data = random.randbytes(SIZE)
+    create_file(str(path), SIZE)
+    hasher = InlineHasher('md5', str(path))
+
+    boundaries = [0, SIZE // 4, SIZE // 2, 3 * SIZE // 4, SIZE]
+    write_ranges(path, data, list(zip(boundaries, boundaries[1:])), hasher)
+
+    # Everything has been hashed by the writes, none of it is left for ``finish``
+    assert hasher.offset == SIZE
+    assert hasher.finish() == hashlib.md5(data).hexdigest()
+
+
+def test_bytes_of_an_earlier_run_are_hashed_too(tmp_path: Path):
+    path = tmp_path / 'file.part'
+    data = random.randbytes(SIZE)
+    create_file(str(path), SIZE)
+    # An earlier run wrote the beginning of both ranges
+    path.write_bytes(data[:1000] + bytes(SIZE // 2 - 1000) + data[SIZE // 2:SIZE // 2 + 1000])
+    hasher = InlineHasher('md5', str(path))
+    hasher.mark_written(0, 1000)
+    hasher.mark_written(SIZE // 2, 1000)
+
+    write_ranges(path, data, [(1000, SIZE // 2), (SIZE // 2 + 1000, SIZE)], hasher)
+
+    assert hasher.offset == SIZE
+    assert hasher.finish() == hashlib.md5(data).hexdigest()
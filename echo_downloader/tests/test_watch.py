@@ -0,0 +1,55 @@
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+
+from echo_downloader.config_wrapper import EchoDownloaderConfig
+from echo_downloader.domain import Echo360Lecture, FileInfo
+from echo_downloader.main import is_lecture_finished
+from echo_downloader.manifest import DownloadManifest
+from echo_downloader.merger import get_output_path
+
+
+@pytest.fixture
+def manifest(tmp_path: Path) -> DownloadManifest:
+    with DownloadManifest(str(tmp_path / 'manifest.sqlite3')) as manifest:
+        yield manifest
+
+
+def create_lecture(*file_names: str) -> Echo360Lecture:
+    held_at = datetime(2024, 4, 10, 10)
+    return Echo360Lecture(held_at, held_at, held_at, 'Course', 'lecture-1', '', 1, 1,
+                          [FileInfo(file_name, f'https://example.com/{file_name}') for file_name in file_names])
+
+
+def record_merged_output(manifest: DownloadManifest, output_path: str) -> None:
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(output_path).write_bytes(b'merged')
+    manifest.record_output('lecture-1', output_path, audio_file='s0q1.m4s', video_file='s1q1.m4s')
+
+
+def test_lecture_with_nothing_planned_is_not_finished(config: EchoDownloaderConfig, manifest: DownloadManifest,
+                                                      tmp_path: Path):
+    # Like after a partial capture, which only found the audio, or a failed probe
+    lecture = create_lecture()
+
+    assert not is_lecture_finished(config, str(tmp_path), lecture, manifest)
+
+
+def test_lecture_merged_by_an_earlier_run_is_finished(config: EchoDownloaderConfig, manifest: DownloadManifest,
+                                                      tmp_path: Path):
+    # The planner leaves out the outputs that have been merged already
+    lecture = create_lecture()
+    title_suffix = next(iter(config.file_pairs))
+    record_merged_output(manifest, get_output_path(str(tmp_path), lecture, title_suffix))
+
+    assert is_lecture_finished(config, str(tmp_path), lecture, manifest)
+
+
+def test_lecture_with_an_unmerged_planned_output_is_not_finished(config: EchoDownloaderConfig,
+                                                                 manifest: DownloadManifest, tmp_path: Path):
+    screen_suffix, camera_suffix = list(config.file_pairs)[:2]
+    lecture = create_lecture(*config.file_pairs[camera_suffix][0])
+    record_merged_output(manifest, get_output_path(str(tmp_path), lecture, screen_suffix))
+
+    assert not is_lecture_finished(config, str(tmp_path), lecture, manifest)